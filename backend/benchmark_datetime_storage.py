@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark ISO string timestamps against native BSON dates
+
+Compares encoded document size for the stored models and the latency of the
+get_statuses range query (user_id $in, expires_at $gt now) on both layouts.
+Runs against MONGO_URL in a scratch database that is dropped afterwards.
+
+Usage:
+    python benchmark_datetime_storage.py [--docs N] [--users N] [--runs N]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import bson
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+def as_iso(doc):
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in doc.items()}
+
+def make_status(user_id, now):
+    created_at = now - timedelta(hours=random.uniform(0, 48))
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "content_type": "text",
+        "content": "Hello from the benchmark",
+        "media_url": None,
+        "background_color": "#075E54",
+        "viewers": [],
+        "privacy": "contacts",
+        "created_at": created_at,
+        "expires_at": created_at + timedelta(hours=24)
+    }
+
+def make_message(now):
+    return {
+        "id": str(uuid.uuid4()),
+        "chat_id": str(uuid.uuid4()),
+        "sender_id": str(uuid.uuid4()),
+        "content": "See you at 6?",
+        "message_type": "text",
+        "reply_to": None,
+        "forwarded_from": None,
+        "attachments": [],
+        "reactions": [],
+        "status": "sent",
+        "is_edited": False,
+        "is_deleted": False,
+        "deleted_for": [],
+        "encryption_data": None,
+        "created_at": now,
+        "edited_at": now,
+        "expires_at": None
+    }
+
+def report_sizes(now):
+    print("Encoded document size (bytes)")
+    for name, doc in (("message", make_message(now)), ("status", make_status("u", now))):
+        iso_size = len(bson.encode(as_iso(doc)))
+        date_size = len(bson.encode(doc))
+        saved = 100 * (iso_size - date_size) / iso_size
+        print(f"  {name:<8} iso={iso_size:<5} date={date_size:<5} saved={saved:.1f}%")
+
+async def time_query(collection, query, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await collection.find(query, {"_id": 0}).sort("created_at", -1).to_list(None)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+async def main(args):
+    now = datetime.now(timezone.utc)
+    report_sizes(now)
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    bench_db = client[f"{os.environ['DB_NAME']}_bench"]
+    try:
+        users = [str(uuid.uuid4()) for _ in range(args.users)]
+        statuses = [make_status(random.choice(users), now) for _ in range(args.docs)]
+        layouts = {
+            "iso": (bench_db.status_iso, [as_iso(s) for s in statuses], now.isoformat()),
+            "date": (bench_db.status_date, statuses, now),
+        }
+
+        contacts = random.sample(users, min(50, len(users)))
+        print(f"\nget_statuses query, {args.docs} statuses, {len(contacts)} contacts, {args.runs} runs")
+        for name, (collection, docs, threshold) in layouts.items():
+            await collection.drop()
+            await collection.create_index([("user_id", ASCENDING), ("expires_at", ASCENDING)])
+            await collection.insert_many([dict(d) for d in docs])
+            stats = await bench_db.command("collStats", collection.name)
+            query = {"user_id": {"$in": contacts}, "expires_at": {"$gt": threshold}}
+            p50, p95 = await time_query(collection, query, args.runs)
+            print(f"  {name:<5} avgObjSize={stats['avgObjSize']:<5} "
+                  f"indexSize={stats['totalIndexSize']:<9} p50={p50:.2f}ms p95={p95:.2f}ms")
+    finally:
+        await client.drop_database(bench_db.name)
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
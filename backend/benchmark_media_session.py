@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark bytes served for a typical media session
+
+Uploads a video, a voice note and an avatar to a running backend, then
+replays a session against GET /api/files twice: once as a naive client that
+re-downloads whole files, and once using Range requests for seeks and
+scrubbing and If-None-Match for repeat loads. Reports bytes received and
+wall time for each.
+
+Usage:
+    python benchmark_media_session.py [--url http://localhost:8001] [--video-mb 40]
+"""
+import argparse
+import asyncio
+import io
+import os
+import time
+
+import aiohttp
+from PIL import Image
+
+async def upload(http, api, name, data, content_type):
+    form = aiohttp.FormData()
+    form.add_field("file", data, filename=name, content_type=content_type)
+    async with http.post(f"{api}/upload", params={"user_id": "bench"}, data=form) as resp:
+        resp.raise_for_status()
+        return (await resp.json())["file_url"]
+
+def session_plan(video_size, voice_size):
+    """(file, byte range or None) requests a player and chat screen would make"""
+    mb = 1024 * 1024
+    plan = [("avatar", None)] * 6                                   # chat list, header, profile, re-renders
+    plan += [("video", (0, mb - 1))]                                # start playback
+    plan += [("video", (int(video_size * f), int(video_size * f) + mb - 1)) for f in (0.5, 0.25, 0.8)]  # seeks
+    plan += [("voice", (int(voice_size * f), voice_size - 1)) for f in (0, 0.3, 0.6, 0.3)]  # scrubbing
+    return plan
+
+async def naive(http, base, urls, plan):
+    received = 0
+    for name, _ in plan:
+        async with http.get(f"{base}{urls[name]}") as resp:
+            received += len(await resp.read())
+    return received
+
+async def conditional(http, base, urls, plan):
+    received = 0
+    etags = {}
+    for name, byte_range in plan:
+        headers = {}
+        if byte_range:
+            headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        elif name in etags:
+            headers["If-None-Match"] = etags[name]
+        async with http.get(f"{base}{urls[name]}", headers=headers) as resp:
+            body = await resp.read()
+            received += len(body)
+            if resp.status == 200:
+                etags[name] = resp.headers["ETag"]
+    return received
+
+async def main(args):
+    api = f"{args.url}/api"
+    avatar = io.BytesIO()
+    Image.new("RGB", (640, 640), (7, 94, 84)).save(avatar, "JPEG", quality=95)
+    video = os.urandom(args.video_mb * 1024 * 1024)
+    voice = os.urandom(args.voice_kb * 1024)
+
+    async with aiohttp.ClientSession() as http:
+        urls = {
+            "avatar": await upload(http, api, "avatar.jpg", avatar.getvalue(), "image/jpeg"),
+            "video": await upload(http, api, "clip.mp4", video, "video/mp4"),
+            "voice": await upload(http, api, "note.ogg", voice, "audio/ogg"),
+        }
+        plan = session_plan(len(video), len(voice))
+        print(f"Media session: {len(plan)} requests, video {args.video_mb} MiB, voice {args.voice_kb} KiB")
+        for label, run in (("full downloads", naive), ("range + etag", conditional)):
+            start = time.perf_counter()
+            received = await run(http, args.url, urls, plan)
+            elapsed = time.perf_counter() - start
+            print(f"  {label:<15} {received / 1024 / 1024:>9.2f} MiB in {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--video-mb", type=int, default=40)
+    parser.add_argument("--voice-kb", type=int, default=600)
+    asyncio.run(main(parser.parse_args()))
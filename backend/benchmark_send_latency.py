@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark message send latency: HTTP POST /api/messages vs the socket event
+
+Logs two users in against a running backend (mock OTP), opens a direct chat
+and sends --count messages one at a time over each path, waiting for the
+HTTP response or the socket ack before the next send. Reports p50/p99/max
+round-trip latency per path.
+
+Usage:
+    python benchmark_send_latency.py [--url http://localhost:8001] [--count 2000] [--warmup 100]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+import socketio
+
+async def login(http, api, phone):
+    await http.post(f"{api}/auth/request-otp", json={"phone_number": phone})
+    async with http.post(f"{api}/auth/verify-otp", json={
+        "phone_number": phone, "otp": "123456", "device_name": "bench",
+        "device_type": "web", "public_key": "bench"
+    }) as resp:
+        resp.raise_for_status()
+        return (await resp.json())["user"]["id"]
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def report(name, samples):
+    samples.sort()
+    print(f"  {name:<7} p50={statistics.median(samples):.2f}ms p99={percentile(samples, 99):.2f}ms "
+          f"max={samples[-1]:.2f}ms")
+
+async def bench_http(http, api, user_id, chat_id, count):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        async with http.post(f"{api}/messages", params={"user_id": user_id},
+                             json={"chat_id": chat_id, "content": f"http {i}"}) as resp:
+            resp.raise_for_status()
+            await resp.read()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+async def bench_socket(client, chat_id, count):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        ack = await client.call('send_message', {"chat_id": chat_id, "content": f"socket {i}"})
+        if "error" in ack:
+            raise RuntimeError(f"socket send failed: {ack['error']}")
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+async def main(args):
+    api = f"{args.url}/api"
+    async with aiohttp.ClientSession() as http:
+        sender = await login(http, api, "+14155550101")
+        peer = await login(http, api, "+14155550102")
+        async with http.post(f"{api}/chats", params={"user_id": sender},
+                             json={"type": "direct", "participants": [peer]}) as resp:
+            resp.raise_for_status()
+            chat_id = (await resp.json())["id"]
+
+        client = socketio.AsyncClient()
+        await client.connect(args.url, transports=["websocket"])
+        authenticated = asyncio.Event()
+        client.on('authenticated', lambda data: authenticated.set())
+        await client.emit('authenticate', {"user_id": sender})
+        await asyncio.wait_for(authenticated.wait(), 10)
+
+        try:
+            await bench_http(http, api, sender, chat_id, args.warmup)
+            await bench_socket(client, chat_id, args.warmup)
+            http_samples = await bench_http(http, api, sender, chat_id, args.count)
+            socket_samples = await bench_socket(client, chat_id, args.count)
+        finally:
+            await client.disconnect()
+
+    print(f"Send round trip, {args.count} sequential messages")
+    report("http", http_samples)
+    report("socket", socket_samples)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark Socket.IO emit throughput as uvicorn workers are added
+
+For each worker count, starts `uvicorn server:app --workers N` with the
+Unix-socket pub/sub manager, connects --users Socket.IO clients spread over
+several client processes, and has every client send call_signal events at
+random other users for --duration seconds. Each client waits for the
+server's acknowledgement before sending the next signal, so the load follows
+what the server can take. Reports acknowledged and delivered signals per
+second and the speed-up in deliveries over the first worker count. Needs
+MONGO_URL (the authenticate handler touches the database).
+
+Usage:
+    python benchmark_socket_fanout.py [--workers 1 2 4] [--users 200] [--duration 10]
+
+Measured with --users 100 --duration 8 on a single vCPU. The hub, the
+workers and the client processes all shared that core. The database was an
+in-memory mock, which call_signal never reads.
+
+    workers    acked/s  delivered/s  speed-up
+          1       1099         1102     1.00x
+          2        981          536     0.49x
+          4       1708          598     0.54x
+
+A second run gave 930, 511 and 434 delivered/s. When signals still in
+flight at the end of the window are counted too, 2 workers deliver every
+acknowledged signal. The deliveries are late, not lost: on one core the extra
+hop through the hub costs more than another worker adds. Speed-up therefore
+has to be measured on a multi-core host.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import socketio
+
+ROOT_DIR = Path(__file__).parent
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"backend did not start on port {port}")
+
+def start_backend(workers, port, hub_path):
+    env = {**os.environ, "SOCKETIO_MANAGER": f"unix://{hub_path}"}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT_DIR, env=env
+    )
+
+async def run_clients(port, user_ids, all_user_ids, start_at, duration):
+    received = 0
+    acked = 0
+    clients = []
+
+    for user_id in user_ids:
+        client = socketio.AsyncClient(reconnection=False)
+
+        @client.on('call_signal')
+        async def on_signal(data):
+            nonlocal received
+            if start_at <= time.time() < start_at + duration:
+                received += 1
+
+        await client.connect(f"http://127.0.0.1:{port}", transports=["websocket"])
+        await client.emit('authenticate', {"user_id": user_id})
+        clients.append((user_id, client))
+
+    async def fire(user_id, client):
+        nonlocal acked
+        await asyncio.sleep(max(0, start_at - time.time()))
+        while time.time() < start_at + duration:
+            target = random.choice(all_user_ids)
+            if target != user_id:
+                try:
+                    await client.call('call_signal', {"target_user_id": target, "signal": {"from": user_id}},
+                                      timeout=10)
+                except socketio.exceptions.TimeoutError:
+                    continue
+                if time.time() < start_at + duration:
+                    acked += 1
+
+    await asyncio.gather(*(fire(user_id, client) for user_id, client in clients))
+    await asyncio.sleep(1)  # let in-flight signals land
+    for _, client in clients:
+        await client.disconnect()
+    return acked, received
+
+def client_process(port, user_ids, all_user_ids, start_at, duration, results):
+    results.put(asyncio.run(run_clients(port, user_ids, all_user_ids, start_at, duration)))
+
+def run_round(workers, args):
+    hub_path = os.path.join(tempfile.gettempdir(), f"wa-bench-{uuid.uuid4().hex[:8]}.sock")
+    backend = start_backend(workers, args.port, hub_path)
+    try:
+        wait_for_port(args.port)
+        time.sleep(1)  # workers past startup hooks
+
+        all_user_ids = [f"bench-{uuid.uuid4().hex[:12]}" for _ in range(args.users)]
+        shards = [all_user_ids[i::args.client_procs] for i in range(args.client_procs)]
+        start_at = time.time() + 3 + args.users / 100
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=client_process,
+                                    args=(args.port, shard, all_user_ids, start_at, args.duration, results))
+            for shard in shards
+        ]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+        return sum(t[0] for t in totals), sum(t[1] for t in totals)
+    finally:
+        backend.terminate()
+        backend.wait()
+        for path in (hub_path, hub_path + ".lock"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--client-procs", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>7} {'acked/s':>10} {'delivered/s':>12} {'speed-up':>9}")
+    for workers in args.workers:
+        acked, delivered = run_round(workers, args)
+        rate = delivered / args.duration
+        baseline = baseline or rate
+        print(f"{workers:>7} {acked / args.duration:>10.0f} {rate:>12.0f} {rate / baseline:>8.2f}x")
+
+if __name__ == "__main__":
+    main()
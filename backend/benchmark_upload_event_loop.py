@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmark event-loop lag during an image upload burst
+
+Starts the backend once with MEDIA_WORKERS=0 (thumbnails decoded inline on
+the event loop) and once with the process pool, then fires --uploads large
+JPEG uploads --concurrency at a time while a probe polls GET /api/metrics.
+The probe's latency is the event-loop lag other requests and sockets see;
+with the pool it should stay flat. Needs MONGO_URL for the startup hooks.
+
+Usage:
+    python benchmark_upload_event_loop.py [--uploads 40] [--concurrency 8] [--size 4000x3000]
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+from PIL import Image, ImageDraw
+
+ROOT_DIR = Path(__file__).parent
+
+def make_jpeg(width, height):
+    img = Image.new("RGB", (width, height), (30, 90, 60))
+    draw = ImageDraw.Draw(img)
+    for _ in range(400):
+        x, y = random.randrange(width), random.randrange(height)
+        colour = tuple(random.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + random.randrange(50, 400), y + random.randrange(50, 400)), fill=colour)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"backend did not start on port {port}")
+
+async def probe(http, url, stop, samples):
+    while not stop.is_set():
+        start = time.perf_counter()
+        async with http.get(url) as resp:
+            await resp.read()
+        samples.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.01)
+
+async def upload_burst(http, url, jpeg, uploads, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+    statuses = []
+
+    async def one(i):
+        async with slots:
+            form = aiohttp.FormData()
+            form.add_field("file", jpeg, filename=f"bench-{i}.jpg", content_type="image/jpeg")
+            async with http.post(url, data=form) as resp:
+                await resp.read()
+                statuses.append(resp.status)
+
+    await asyncio.gather(*(one(i) for i in range(uploads)))
+    return statuses
+
+def summary(samples):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50={statistics.median(samples):.1f}ms p99={p99:.1f}ms max={samples[-1]:.1f}ms"
+
+async def measure(base, jpeg, args):
+    async with aiohttp.ClientSession() as http:
+        idle, busy = [], []
+        stop = asyncio.Event()
+        task = asyncio.create_task(probe(http, f"{base}/api/metrics", stop, idle))
+        await asyncio.sleep(2)
+        stop.set()
+        await task
+
+        stop = asyncio.Event()
+        task = asyncio.create_task(probe(http, f"{base}/api/metrics", stop, busy))
+        start = time.perf_counter()
+        statuses = await upload_burst(http, f"{base}/api/upload?user_id=bench", jpeg, args.uploads, args.concurrency)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await task
+    ok = statuses.count(200)
+    print(f"  idle probe   {summary(idle)}")
+    print(f"  burst probe  {summary(busy)}")
+    print(f"  uploads      {ok}/{len(statuses)} ok in {elapsed:.1f}s ({ok / elapsed:.1f}/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--size", default="4000x3000")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split("x"))
+    jpeg = make_jpeg(width, height)
+    print(f"JPEG {width}x{height}, {len(jpeg) // 1024} KiB")
+
+    for label, workers in (("inline", "0"), ("process pool", os.environ.get("MEDIA_WORKERS", ""))):
+        env = {**os.environ, "MEDIA_WORKERS": workers} if workers else dict(os.environ)
+        backend = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--port", str(args.port), "--log-level", "warning"],
+            cwd=ROOT_DIR, env=env
+        )
+        try:
+            wait_for_port(args.port)
+            print(label)
+            asyncio.run(measure(f"http://127.0.0.1:{args.port}", jpeg, args))
+        finally:
+            backend.terminate()
+            backend.wait()
+
+if __name__ == "__main__":
+    main()
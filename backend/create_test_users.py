@@ -37,8 +37,8 @@ async def create_test_users():
             "about": "Love coding and coffee!",
             "avatar_url": None,
             "public_key": "test_public_key_alice",
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "last_seen": datetime.now(timezone.utc).isoformat(),
+            "created_at": datetime.now(timezone.utc),
+            "last_seen": datetime.now(timezone.utc),
             "privacy_settings": {
                 "profile_photo": "everyone",
                 "about": "everyone",
@@ -56,8 +56,8 @@ async def create_test_users():
             "about": "Always online!",
             "avatar_url": None,
             "public_key": "test_public_key_bob",
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "last_seen": datetime.now(timezone.utc).isoformat(),
+            "created_at": datetime.now(timezone.utc),
+            "last_seen": datetime.now(timezone.utc),
             "privacy_settings": {
                 "profile_photo": "everyone",
                 "about": "everyone",
@@ -75,8 +75,8 @@ async def create_test_users():
             "about": "Tech enthusiast 🚀",
             "avatar_url": None,
             "public_key": "test_public_key_carol",
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "last_seen": datetime.now(timezone.utc).isoformat(),
+            "created_at": datetime.now(timezone.utc),
+            "last_seen": datetime.now(timezone.utc),
             "privacy_settings": {
                 "profile_photo": "everyone",
                 "about": "everyone",
@@ -102,7 +102,7 @@ async def create_test_users():
                     "contact_user_id": user2["id"],
                     "nickname": None,
                     "is_blocked": False,
-                    "created_at": datetime.now(timezone.utc).isoformat()
+                    "created_at": datetime.now(timezone.utc)
                 })
     
     await db.contacts.insert_many(contacts)
@@ -123,8 +123,8 @@ async def create_test_users():
             "encryption_enabled": True
         },
         "invite_link": f"wa://{str(uuid.uuid4())[:8]}",
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
     
     await db.chats.insert_one(group_chat)
@@ -146,7 +146,7 @@ async def create_test_users():
         "is_deleted": False,
         "deleted_for": [],
         "encryption_data": None,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),
         "edited_at": None,
         "expires_at": None
     }
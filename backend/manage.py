@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Database maintenance commands for the WA backend
+
+Usage:
+    python manage.py ensure-indexes
+    python manage.py audit-indexes
+    python manage.py backfill-inbox [--batch-size N]
+    python manage.py migrate-datetimes [--batch-size N] [--collection NAME] [--restart]
+    python manage.py backfill-seq [--batch-size N]
+"""
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from server import (
+    DATETIME_FIELDS, audit_query_plans, client, convert_datetime_fields, db, ensure_indexes,
+    message_preview
+)
+
+async def cmd_ensure_indexes(args):
+    await ensure_indexes()
+    print("✅ Indexes reconciled")
+
+async def cmd_audit_indexes(args):
+    report = await audit_query_plans()
+    for entry in report:
+        print(f"{entry['handler']:<16} {entry['collection']:<10} {' > '.join(entry['stages'])}")
+    print(f"✅ No COLLSCAN in {len(report)} query shapes")
+
+async def cmd_backfill_inbox(args):
+    # Chats without messages still get an explicit empty preview
+    await db.chats.update_many({"last_message": {"$exists": False}}, {"$set": {"last_message": None}})
+    
+    pipeline = [
+        {"$match": {"is_deleted": False}},
+        {"$sort": {"chat_id": 1, "created_at": -1}},
+        {"$group": {"_id": "$chat_id", "message": {"$first": "$$ROOT"}}}
+    ]
+    batch = []
+    updated = 0
+    async for row in db.messages.aggregate(pipeline, allowDiskUse=True):
+        message = row["message"]
+        batch.append(UpdateOne(
+            {"id": row["_id"]},
+            {
+                "$set": {"last_message": message_preview(message)},
+                "$max": {"updated_at": message["created_at"]}
+            }
+        ))
+        if len(batch) >= args.batch_size:
+            updated += (await db.chats.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        updated += (await db.chats.bulk_write(batch, ordered=False)).modified_count
+    print(f"✅ Backfilled last_message on {updated} chats")
+
+async def cmd_migrate_datetimes(args):
+    # Walks each collection in _id order and records the last _id it finished
+    # in db.migrations, so an interrupted run picks up where it stopped.
+    #
+    # Run it to completion BEFORE deploying code that writes BSON dates. Point
+    # reads go through as_utc and accept either representation, but range
+    # filters do not: BSON compares dates and strings as different types, so
+    # documents still holding ISO strings drop out of get_statuses
+    # (expires_at > now), the get_messages and get_chats keyset pages, and the
+    # OTP TTL index, which never expires string dates.
+    collections = [args.collection] if args.collection else list(DATETIME_FIELDS)
+    for name in collections:
+        paths = DATETIME_FIELDS[name]
+        progress_id = f"bson_datetimes:{name}"
+        if args.restart:
+            await db.migrations.delete_one({"_id": progress_id})
+        progress = await db.migrations.find_one({"_id": progress_id}) or {}
+        if progress.get("done"):
+            print(f"⏭️  {name}: already migrated")
+            continue
+        
+        pending = {"$or": [{path: {"$type": "string"}} for path in paths]}
+        last_id = progress.get("last_id")
+        converted = 0
+        while True:
+            query = dict(pending)
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            docs = await db[name].find(query).sort("_id", 1).limit(args.batch_size).to_list(args.batch_size)
+            if not docs:
+                break
+            
+            last_id = docs[-1]["_id"]
+            while docs:
+                batch, queued = [], []
+                for doc in docs:
+                    changes = convert_datetime_fields(doc, paths)
+                    if changes:
+                        # Only overwrite fields nobody has rewritten since we read them
+                        guard = {"_id": doc["_id"], **{key: doc[key] for key in changes}}
+                        batch.append(UpdateOne(guard, {"$set": changes}))
+                        queued.append(doc["_id"])
+                if not batch:
+                    break
+                converted += (await db[name].bulk_write(batch, ordered=False)).modified_count
+                # A guard matches nothing when the app rewrote the document
+                # (a reaction, an edit) after we read it: read those again
+                # instead of walking past them with their strings intact
+                docs = await db[name].find({**pending, "_id": {"$in": queued}}).to_list(None)
+            
+            await db.migrations.update_one(
+                {"_id": progress_id}, {"$set": {"last_id": last_id}}, upsert=True
+            )
+            print(f"   {name}: {converted} documents converted so far")
+        
+        await db.migrations.update_one({"_id": progress_id}, {"$set": {"done": True}}, upsert=True)
+        print(f"✅ {name}: {converted} documents converted")
+
+async def cmd_backfill_seq(args):
+    # Numbers the messages of chats that have never allocated a seq, in
+    # (created_at, id) order. Run it before the sequencing build takes
+    # traffic; chats whose counter is already in use are left alone, since
+    # renumbering them would change seqs clients have already seen.
+    numbered_chats = skipped = 0
+    async for chat in db.chats.find({}, {"_id": 0, "id": 1, "last_seq": 1}):
+        if chat.get("last_seq"):
+            if await db.messages.count_documents({"chat_id": chat["id"], "seq": {"$exists": False}}, limit=1):
+                skipped += 1
+                print(f"⚠️  {chat['id']}: has unsequenced messages but last_seq={chat['last_seq']}, skipped")
+            continue
+        
+        seq = 0
+        batch = []
+        cursor = db.messages.find({"chat_id": chat["id"]}, {"_id": 1}).sort([("created_at", 1), ("id", 1)])
+        async for message in cursor:
+            seq += 1
+            batch.append(UpdateOne({"_id": message["_id"]}, {"$set": {"seq": seq}}))
+            if len(batch) >= args.batch_size:
+                await db.messages.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            await db.messages.bulk_write(batch, ordered=False)
+        await db.chats.update_one({"id": chat["id"]}, {"$max": {"last_seq": seq}})
+        numbered_chats += 1
+    print(f"✅ Numbered {numbered_chats} chats, skipped {skipped}")
+
+COMMANDS = {
+    "ensure-indexes": (cmd_ensure_indexes, "Build missing indexes and drop undeclared ones", []),
+    "audit-indexes": (cmd_audit_indexes, "Explain handler queries and fail on COLLSCAN", []),
+    "backfill-inbox": (cmd_backfill_inbox, "Populate chats.last_message and updated_at from messages", [
+        (("--batch-size",), {"type": int, "default": 500})
+    ]),
+    "migrate-datetimes": (cmd_migrate_datetimes, "Rewrite ISO string timestamps as BSON dates (resumable; finish before deploying)", [
+        (("--batch-size",), {"type": int, "default": 1000}),
+        (("--collection",), {"choices": list(DATETIME_FIELDS)}),
+        (("--restart",), {"action": "store_true", "help": "Ignore saved progress"})
+    ]),
+    "backfill-seq": (cmd_backfill_seq, "Assign seq numbers to messages of never-sequenced chats", [
+        (("--batch-size",), {"type": int, "default": 1000})
+    ]),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="WA database maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text, arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        for flags, kwargs in arguments:
+            subparser.add_argument(*flags, **kwargs)
+    args = parser.parse_args()
+    
+    handler = COMMANDS[args.command][0]
+    try:
+        asyncio.run(handler(args))
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
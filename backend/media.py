@@ -0,0 +1,104 @@
+"""
+CPU-bound image work, run in the media worker processes
+
+Everything here takes and returns plain paths and values so it can be
+pickled to a ProcessPoolExecutor, and imports nothing from server.py so a
+spawned worker starts without the app, the database client or Socket.IO.
+"""
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+THUMBNAIL_SIZE = (200, 200)
+# BlurHash input: placeholders only carry a few cosine components, so a
+# 32px image gives the same string as the full-size one at a fraction of the work
+PLACEHOLDER_INPUT_SIZE = (32, 32)
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+# Encoders for the lazily rendered variants served by /api/files/{id}?w=&fmt=
+VARIANT_ENCODERS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+    "png": ("PNG", {"optimize": True}),
+}
+
+def base83(value: int, length: int) -> str:
+    return "".join(BASE83[value // 83 ** (length - 1 - i) % 83] for i in range(length))
+
+def srgb_to_linear(rgb: np.ndarray) -> np.ndarray:
+    v = rgb / 255.0
+    return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+def linear_to_srgb(value: float) -> int:
+    v = min(max(value, 0.0), 1.0)
+    if v <= 0.0031308:
+        return int(v * 12.92 * 255 + 0.5)
+    return int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def blurhash(img: Image.Image, components: Tuple[int, int]) -> str:
+    """BlurHash of an (already small) image with (x, y) cosine components"""
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        # Transparent areas read as white, like the chat background they sit on
+        rgba = img.convert("RGBA")
+        img = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        img.alpha_composite(rgba)
+    pixels = srgb_to_linear(np.asarray(img.convert("RGB"), dtype=np.float64))
+    height, width = pixels.shape[:2]
+    cx, cy = components
+    
+    # factors[j, i] = sum over pixels of cos(pi*i*x/w) * cos(pi*j*y/h) * rgb
+    basis_x = np.cos(np.pi * np.outer(np.arange(cx), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(cy), np.arange(height)) / height)
+    factors = np.einsum("jy,ix,yxc->jic", basis_y, basis_x, pixels) / (width * height)
+    factors[1:] *= 2
+    factors[0, 1:] *= 2
+    factors = factors.reshape(cx * cy, 3)
+    dc, ac = factors[0], factors[1:]
+    
+    result = base83((cx - 1) + (cy - 1) * 9, 1)
+    if len(ac):
+        quantised_max = int(min(max(np.floor(np.abs(ac).max() * 166 - 0.5), 0), 82))
+        maximum = (quantised_max + 1) / 166
+        result += base83(quantised_max, 1)
+    else:
+        maximum = 1.0
+        result += base83(0, 1)
+    r, g, b = (linear_to_srgb(c) for c in dc)
+    result += base83((r << 16) + (g << 8) + b, 4)
+    
+    scaled = ac / maximum
+    quantised = np.clip(np.floor(np.sign(scaled) * np.abs(scaled) ** 0.5 * 9 + 9.5), 0, 18).astype(int)
+    for qr, qg, qb in quantised:
+        result += base83(qr * 19 * 19 + qg * 19 + qb, 2)
+    return result
+
+def make_thumbnail(source: str, dest: str, size: Tuple[int, int] = THUMBNAIL_SIZE) -> Dict[str, Any]:
+    """Write a thumbnail of source that fits in size; returns the source's
+    dimensions and a BlurHash placeholder taken from the thumbnail"""
+    with Image.open(source) as img:
+        width, height = img.size
+        if img.format == "JPEG":
+            img.draft(img.mode, size)
+        img.thumbnail(size)
+        img.save(dest)
+        small = img.copy()
+    small.thumbnail(PLACEHOLDER_INPUT_SIZE)
+    components = (4, 3) if width >= height else (3, 4)
+    return {"width": width, "height": height, "placeholder": blurhash(small, components)}
+
+def make_variant(source: str, dest: str, width: int, fmt: str) -> Tuple[int, int]:
+    """Write source scaled to width (never up) and encoded as fmt; returns its dimensions"""
+    with Image.open(source) as img:
+        width = min(width, img.width)
+        height = max(1, round(img.height * width / img.width))
+        if img.format == "JPEG":
+            img.draft(img.mode, (width, height))
+        # Palette and bilevel images would only resize with nearest-neighbour
+        source_img = img if img.mode in ("RGB", "RGBA", "L") else img.convert("RGBA")
+        variant = source_img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    encoder, options = VARIANT_ENCODERS[fmt]
+    if encoder == "JPEG" and variant.mode == "RGBA":
+        variant = variant.convert("RGB")
+    variant.save(dest, encoder, **options)
+    return variant.size
@@ -1,58 +1,208 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect, Depends, status
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Query, Request, status
+from fastapi.responses import FileResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import ObjectId
+from bson.errors import InvalidId
 import os
+import asyncio
+import fcntl
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import List, Optional, Dict, Any, Set, Tuple
 import uuid
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
 import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
 import json
 import hashlib
+import mimetypes
 import secrets
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 import base64
+import binascii
 import aiofiles
-from PIL import Image
-import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from python_multipart.multipart import MultipartParser, parse_options_header
 import phonenumbers
+import media
 from phonenumbers import NumberParseException
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection. Timestamps are stored as BSON dates and read back as
+# aware UTC datetimes; they only become ISO strings at the API edge.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # Create upload directory
 UPLOAD_DIR = ROOT_DIR / 'uploads'
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+class SocketJSON:
+    """json module for Socket.IO packets that writes datetimes as ISO strings"""
+    
+    @staticmethod
+    def _default(value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json.dumps(obj, default=SocketJSON._default, **kwargs)
+    
+    loads = staticmethod(json.loads)
+
+# ===== SOCKET.IO PUB/SUB =====
+
+class UnixSocketManager(AsyncPubSubManager):
+    """Socket.IO pub/sub between worker processes on one host over a Unix socket.
+
+    No external service: the first worker to take the lock file runs a hub on
+    the socket path that relays every frame to all connected workers, itself
+    included (the base class skips frames carrying its own host_id). The other
+    workers connect as clients and one of them takes over the hub if its owner
+    exits. Frames are newline-delimited JSON.
+    """
+    name = 'unixsocket'
+    FRAME_LIMIT = 16 * 1024 * 1024
+    
+    def __init__(self, path: str, channel: str = 'socketio', write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._connect_lock = None
+        self._lock_fd = None
+        self._hub = None
+        self._hub_peers: Set[asyncio.StreamWriter] = set()
+    
+    async def _start_hub(self) -> bool:
+        """Become the hub if nobody holds the lock; False when another process does"""
+        fd = os.open(self.path + '.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left behind by a hub that died
+        self._hub = await asyncio.start_unix_server(self._relay, path=self.path, limit=self.FRAME_LIMIT)
+        self._get_logger().info(f'Socket.IO hub listening on {self.path}')
+        return True
+    
+    async def _relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._hub_peers.add(writer)
+        try:
+            while True:
+                frame = await reader.readline()
+                if not frame:
+                    break
+                peers = list(self._hub_peers)
+                for peer in peers:
+                    peer.write(frame)
+                await asyncio.gather(*(peer.drain() for peer in peers), return_exceptions=True)
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            # Peer went away, or the hub is shutting down with the worker
+            pass
+        finally:
+            self._hub_peers.discard(writer)
+            writer.close()
+    
+    async def _connection(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            while self._writer is None or self._writer.is_closing():
+                try:
+                    self._reader, self._writer = await asyncio.open_unix_connection(
+                        self.path, limit=self.FRAME_LIMIT
+                    )
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if not await self._start_hub():
+                        await asyncio.sleep(0.1)
+            return self._reader, self._writer
+    
+    def _reset(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+    
+    async def _publish(self, data):
+        frame = SocketJSON.dumps(data).encode() + b'\n'
+        for attempt in range(2):
+            _, writer = await self._connection()
+            try:
+                writer.write(frame)
+                await writer.drain()
+                return
+            except ConnectionError:
+                self._reset()
+        self._get_logger().error('Cannot publish to the Socket.IO hub, dropping message')
+    
+    async def _listen(self):
+        while True:
+            reader, _ = await self._connection()
+            try:
+                frame = await reader.readline()
+            except (ConnectionError, ValueError):
+                frame = b''
+            if not frame:
+                self._reset()
+                continue
+            yield frame.decode()
+
+class RedisManager(socketio.AsyncRedisManager):
+    """AsyncRedisManager that publishes with SocketJSON, so datetimes survive"""
+    
+    async def _publish(self, data):
+        await super()._publish(json.loads(SocketJSON.dumps(data)))
+
+def make_client_manager():
+    """Client manager named by SOCKETIO_MANAGER.
+
+    unset or memory://     this process only (single worker)
+    unix:///path/to/sock   several workers on one host, no external service
+    redis://host:port/db   several hosts (needs the redis package)
+    """
+    url = os.environ.get('SOCKETIO_MANAGER', '')
+    if not url or url.startswith('memory:'):
+        return None
+    if url.startswith('unix://'):
+        return UnixSocketManager(url[len('unix://'):])
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisManager(url)
+    raise RuntimeError(f"Unsupported SOCKETIO_MANAGER: {url}")
+
 # Socket.IO Server
 sio = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins='*',
     ping_timeout=60,
-    ping_interval=25
+    ping_interval=25,
+    json=SocketJSON,
+    client_manager=make_client_manager()
 )
 
 # Create FastAPI app
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
-# Store active connections
-active_connections: Dict[str, str] = {}  # user_id -> socket_id
-user_devices: Dict[str, List[str]] = {}  # user_id -> [device_ids]
-
 # ===== MODELS =====
 
 class User(BaseModel):
@@ -63,6 +213,7 @@ class User(BaseModel):
     username: Optional[str] = None
     display_name: str
     avatar_url: Optional[str] = None
+    avatar_media_ids: List[str] = Field(default_factory=list)  # stored files the avatar holds a reference on
     about: Optional[str] = ""
     public_key: Optional[str] = None
     identity_key: Optional[str] = None
@@ -114,6 +265,8 @@ class Chat(BaseModel):
     })
     invite_link: Optional[str] = None
     pinned_message_id: Optional[str] = None
+    last_seq: int = 0  # highest message seq allocated in this chat
+    last_message: Optional[Dict[str, Any]] = None  # compact preview, see message_preview()
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -121,14 +274,17 @@ class Message(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     chat_id: str
+    seq: Optional[int] = None  # per-chat, allocated by SequenceAllocator; failed sends leave a "gap" placeholder
     sender_id: str
+    client_message_id: Optional[str] = None  # sender's idempotency key
     content: str
     message_type: str = "text"  # text, image, video, audio, document, location, contact
     reply_to: Optional[str] = None
     forwarded_from: Optional[str] = None
     attachments: List[Dict[str, Any]] = Field(default_factory=list)
+    media_ids: List[str] = Field(default_factory=list)  # stored files this message holds a reference on
     reactions: List[Dict[str, Any]] = Field(default_factory=list)
-    status: str = "sent"  # sent, delivered, read
+    status: str = "sent"  # sent, delivered, read; derived from receipts for sequenced messages
     is_edited: bool = False
     is_deleted: bool = False
     deleted_for: List[str] = Field(default_factory=list)
@@ -144,6 +300,7 @@ class Status(BaseModel):
     content_type: str  # text, image, video
     content: str
     media_url: Optional[str] = None
+    media_ids: List[str] = Field(default_factory=list)  # stored files held until the status expires
     background_color: Optional[str] = None
     viewers: List[str] = Field(default_factory=list)
     privacy: str = "contacts"  # contacts, everyone, custom
@@ -182,6 +339,11 @@ class MessageCreate(BaseModel):
     message_type: str = "text"
     reply_to: Optional[str] = None
     attachments: List[Dict[str, Any]] = Field(default_factory=list)
+    client_message_id: Optional[str] = None  # retries with the same key return the stored message
+
+class MessageBatchCreate(BaseModel):
+    # Validated per item by the handler, so one bad item fails only itself
+    messages: List[Any]
 
 class ChatCreate(BaseModel):
     type: str
@@ -192,6 +354,831 @@ class ContactAdd(BaseModel):
     phone_number: Optional[str] = None
     username: Optional[str] = None
 
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int = Field(ge=0)
+    content_type: Optional[str] = None
+    sha256: Optional[str] = None  # checked at finalize when given
+
+# ===== INDEXES =====
+
+# How long /api/sync can replay; older tokens get a reset
+CHANGE_LOG_RETENTION_SECONDS = int(os.environ.get('CHANGE_LOG_RETENTION_SECONDS', 7 * 24 * 3600))
+
+# Every index the handlers rely on, per collection. ensure_indexes() treats
+# this map as the source of truth: missing indexes are built, and indexes that
+# are not declared here (or whose spec changed) are dropped.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Partial, not sparse: sparse still indexes explicit nulls, which older
+        # user documents store for a missing phone number / email
+        IndexModel([("phone_number", ASCENDING)], name="phone_number_unique", unique=True,
+                   partialFilterExpression={"phone_number": {"$type": "string"}}),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True,
+                   partialFilterExpression={"email": {"$type": "string"}}),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True,
+                   partialFilterExpression={"username": {"$type": "string"}}),
+    ],
+    "otps": [
+        IndexModel([("phone_number", ASCENDING)], name="phone_number"),
+        IndexModel([("email", ASCENDING)], name="email"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "devices": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ],
+    "contacts": [
+        IndexModel([("user_id", ASCENDING), ("contact_user_id", ASCENDING)], name="user_contact_unique", unique=True),
+        IndexModel([("contact_user_id", ASCENDING)], name="contact_user_id"),
+    ],
+    "chats": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Multikey on participants, ordered like the inbox in get_chats
+        IndexModel([("participants", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)],
+                   name="participants_updated_at"),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Keyset order for get_messages; the id suffix breaks created_at ties
+        IndexModel([("chat_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="chat_created_at_id"),
+        # Partial: messages written before sequencing have no seq
+        IndexModel([("chat_id", ASCENDING), ("seq", ASCENDING)], name="chat_seq_unique", unique=True,
+                   partialFilterExpression={"seq": {"$exists": True}}),
+        # Idempotent sends; partial so messages without a key (stored as null) don't collide
+        IndexModel([("chat_id", ASCENDING), ("sender_id", ASCENDING), ("client_message_id", ASCENDING)],
+                   name="chat_sender_client_message_id_unique", unique=True,
+                   partialFilterExpression={"client_message_id": {"$type": "string"}}),
+    ],
+    "status": [
+        IndexModel([("user_id", ASCENDING), ("expires_at", ASCENDING)], name="user_expires_at"),
+        # Expired statuses whose media references media_gc still has to give back
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_media",
+                   partialFilterExpression={"media_ids": {"$type": "string"}}),
+    ],
+    "calls": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("chat_id", ASCENDING)], name="chat_id"),
+    ],
+    "receipts": [
+        IndexModel([("chat_id", ASCENDING), ("user_id", ASCENDING)], name="chat_user_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("unread", ASCENDING)], name="user_unread"),
+    ],
+    "presence": [
+        IndexModel([("sockets.node", ASCENDING)], name="sockets_node"),
+    ],
+    "presence_nodes": [
+        IndexModel([("seen_at", ASCENDING)], name="seen_at"),
+    ],
+    "changes": [
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_id_id"),
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl",
+                   expireAfterSeconds=CHANGE_LOG_RETENTION_SECONDS),
+    ],
+    # Not TTL indexes: the GC tasks must delete files as well
+    "media": [
+        IndexModel([("refcount", ASCENDING), ("claimed_at", ASCENDING)], name="refcount_claimed_at"),
+    ],
+    "upload_sessions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+    ],
+}
+
+AUDIT_TIME = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+# Representative query shapes issued by the handlers. audit_query_plans()
+# explains each of them and refuses any plan that falls back to COLLSCAN.
+#
+# Known scan, deliberately not listed: search_users matches unanchored,
+# case-insensitive regexes, which no B-tree index can bound. It reads users
+# until it has 20 matches; a real fix is a text or n-gram search index.
+QUERY_SHAPES: List[Dict[str, Any]] = [
+    {"handler": "get_user_by_id", "collection": "users", "filter": {"id": "audit"}},
+    {"handler": "verify_otp", "collection": "otps", "filter": {"phone_number": "+10000000000"}},
+    {"handler": "verify_otp", "collection": "otps", "filter": {"email": "audit@example.com"}},
+    {"handler": "verify_otp", "collection": "users", "filter": {"phone_number": "+10000000000"}},
+    {"handler": "verify_otp", "collection": "users", "filter": {"email": "audit@example.com"}},
+    {"handler": "add_contact", "collection": "users", "filter": {"username": "audit"}},
+    {"handler": "add_contact", "collection": "contacts", "filter": {"user_id": "audit", "contact_user_id": "audit"}},
+    {"handler": "get_contacts", "collection": "contacts", "filter": {"user_id": "audit", "is_blocked": False}},
+    {"handler": "get_contacts", "collection": "users", "filter": {"id": {"$in": ["audit"]}}},
+    {"handler": "create_chat", "collection": "chats", "filter": {"type": "direct", "participants": {"$all": ["audit", "audit2"]}}},
+    {"handler": "get_chats", "collection": "chats", "filter": {
+        "participants": "audit",
+        "updated_at": {"$lte": AUDIT_TIME},
+        "$or": [{"updated_at": {"$lt": AUDIT_TIME}}, {"updated_at": AUDIT_TIME, "id": {"$lt": "audit"}}]
+    }, "sort": [("updated_at", -1), ("id", -1)]},
+    {"handler": "delete_message", "collection": "messages", "filter": {"chat_id": "audit", "is_deleted": False},
+     "sort": [("created_at", -1)]},
+    {"handler": "get_messages", "collection": "messages", "filter": {
+        "chat_id": "audit", "is_deleted": False, "deleted_for": {"$ne": "audit"}
+    }, "sort": [("created_at", -1), ("id", -1)]},
+    {"handler": "get_messages", "collection": "messages", "filter": {
+        "chat_id": "audit", "is_deleted": False, "deleted_for": {"$ne": "audit"},
+        "created_at": {"$gte": AUDIT_TIME},
+        "$or": [{"created_at": {"$gt": AUDIT_TIME}}, {"created_at": AUDIT_TIME, "id": {"$gt": "audit"}}]
+    }, "sort": [("created_at", 1), ("id", 1)]},
+    {"handler": "get_messages", "collection": "messages", "filter": {
+        "chat_id": "audit", "deleted_for": {"$ne": "audit"}, "seq": {"$gte": 1, "$lte": 100}
+    }, "sort": [("seq", 1)]},
+    {"handler": "send_message", "collection": "chats", "filter": {"id": "audit"}},
+    {"handler": "send_message", "collection": "messages", "filter": {
+        "chat_id": "audit", "sender_id": "audit", "client_message_id": "audit"
+    }},
+    {"handler": "update_message", "collection": "messages", "filter": {"id": "audit"}},
+    {"handler": "get_statuses", "collection": "contacts", "filter": {"user_id": "audit"}},
+    {"handler": "get_statuses", "collection": "status", "filter": {
+        "user_id": {"$in": ["audit"]}, "expires_at": {"$gt": AUDIT_TIME}
+    }, "sort": [("created_at", -1)]},
+    {"handler": "create_status", "collection": "contacts", "filter": {"contact_user_id": "audit"}},
+    {"handler": "sync", "collection": "changes", "filter": {
+        "user_id": "audit", "_id": {"$gt": ObjectId.from_datetime(AUDIT_TIME)}
+    }, "sort": [("_id", 1)]},
+    {"handler": "get_messages", "collection": "receipts", "filter": {"chat_id": "audit"}},
+    {"handler": "get_chats", "collection": "receipts", "filter": {"user_id": "audit", "chat_id": {"$in": ["audit"]}}},
+    {"handler": "get_chats", "collection": "receipts", "filter": {"user_id": "audit", "unread": {"$gt": 0}}},
+    {"handler": "message_read", "collection": "messages", "filter": {"id": {"$in": ["audit"]}}},
+    {"handler": "message_read", "collection": "chats", "filter": {"id": {"$in": ["audit"]}, "participants": "audit"}},
+    {"handler": "activity_buffer", "collection": "devices", "filter": {"id": "audit"}},
+    {"handler": "presence_heartbeat", "collection": "presence", "filter": {"sockets.node": {"$in": ["audit"]}}},
+    {"handler": "presence_heartbeat", "collection": "presence_nodes", "filter": {"seen_at": {"$lt": AUDIT_TIME}}},
+    {"handler": "authenticate", "collection": "users", "filter": {"id": "audit"}},
+    {"handler": "authenticate", "collection": "chats", "filter": {"participants": "audit"}},
+    {"handler": "presence_audiences", "collection": "contacts", "filter": {
+        "contact_user_id": {"$in": ["audit"]}, "is_blocked": {"$ne": True}
+    }},
+    {"handler": "presence_audiences", "collection": "contacts", "filter": {"user_id": {"$in": ["audit"]}, "is_blocked": True}},
+    {"handler": "presence_audiences", "collection": "chats", "filter": {"participants": {"$in": ["audit"]}}},
+    {"handler": "put_upload_chunk", "collection": "upload_sessions", "filter": {"id": "audit"}},
+    {"handler": "upload_session_gc", "collection": "upload_sessions", "filter": {"expires_at": {"$lte": AUDIT_TIME}}},
+    {"handler": "media_gc", "collection": "status", "filter": {
+        "expires_at": {"$lte": AUDIT_TIME}, "media_ids": {"$type": "string"}
+    }},
+    {"handler": "media_gc", "collection": "media", "filter": {"refcount": {"$lte": 0}, "claimed_at": {"$lt": AUDIT_TIME}}},
+]
+
+def _index_matches(existing: Dict[str, Any], declared: Dict[str, Any]) -> bool:
+    """Compare an index_information() entry against a declared IndexModel document"""
+    existing_key = [(field, int(direction)) for field, direction in existing["key"]]
+    if existing_key != list(declared["key"].items()):
+        return False
+    for option in ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression"):
+        if existing.get(option) != declared.get(option):
+            return False
+    return True
+
+async def ensure_indexes(database=None):
+    """Reconcile the live indexes of every collection with INDEXES"""
+    database = db if database is None else database
+    for collection_name, models in INDEXES.items():
+        collection = database[collection_name]
+        declared = {model.document["name"]: model for model in models}
+        existing = await collection.index_information()
+        
+        for name, info in list(existing.items()):
+            if name == "_id_":
+                continue
+            model = declared.get(name)
+            if model is None or not _index_matches(info, model.document):
+                logger.info(f"Dropping index {collection_name}.{name}")
+                try:
+                    await collection.drop_index(name)
+                except OperationFailure as e:
+                    # Another worker reconciling at the same time got there first
+                    logger.warning(f"Dropping index {collection_name}.{name} failed: {e}")
+                existing.pop(name)
+        
+        # One at a time, so an index that cannot be built (e.g. existing
+        # duplicates) doesn't keep the rest of the collection's indexes from building
+        created = []
+        for name, model in declared.items():
+            if name in existing:
+                continue
+            try:
+                await collection.create_indexes([model])
+                created.append(name)
+            except OperationFailure as e:
+                logger.error(f"Index creation failed on {collection_name}.{name}: {e}")
+        if created:
+            logger.info(f"Created indexes on {collection_name}: {', '.join(created)}")
+
+def _plan_stages(plan: Any) -> List[str]:
+    """Collect every stage name in an explain() plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+async def audit_query_plans(database=None) -> List[Dict[str, Any]]:
+    """Explain every QUERY_SHAPES entry and raise if any of them collection-scans"""
+    database = db if database is None else database
+    report = []
+    for shape in QUERY_SHAPES:
+        cursor = database[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        explain = await cursor.explain()
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        report.append({
+            "handler": shape["handler"],
+            "collection": shape["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    
+    offenders = [r for r in report if r["collscan"]]
+    if offenders:
+        details = "; ".join(f"{r['handler']} on {r['collection']}" for r in offenders)
+        raise RuntimeError(f"Query plan audit failed, COLLSCAN in: {details}")
+    return report
+
+# ===== DATETIME STORAGE =====
+
+# Datetime fields per collection, dotted through embedded documents and
+# arrays. Used by the BSON date migration in manage.py.
+DATETIME_FIELDS: Dict[str, List[str]] = {
+    "users": ["created_at", "last_seen"],
+    "devices": ["created_at", "last_active"],
+    "contacts": ["created_at"],
+    "chats": ["created_at", "updated_at", "last_message.created_at"],
+    "messages": ["created_at", "edited_at", "expires_at", "reactions.created_at"],
+    "status": ["created_at", "expires_at"],
+    "calls": ["started_at", "ended_at"],
+    "otps": ["created_at", "expires_at"],
+}
+
+def as_utc(value: Any) -> datetime:
+    """Datetime read from Mongo, tolerating ISO strings written before the BSON date migration"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def _convert_path(value: Any, parts: List[str]) -> Any:
+    if isinstance(value, list):
+        return [_convert_path(item, parts) for item in value]
+    if not parts:
+        return as_utc(value) if isinstance(value, str) else value
+    if isinstance(value, dict) and parts[0] in value:
+        value = dict(value)
+        value[parts[0]] = _convert_path(value[parts[0]], parts[1:])
+    return value
+
+def convert_datetime_fields(doc: Dict[str, Any], paths: List[str]) -> Dict[str, Any]:
+    """Top-level fields of doc that change when ISO strings under paths become datetimes"""
+    converted = doc
+    for path in paths:
+        converted = _convert_path(converted, path.split("."))
+    return {key: converted[key] for key in converted if converted[key] != doc[key]}
+
+# ===== MESSAGE SEQUENCES =====
+
+class SequenceAllocator:
+    """Allocates per-chat message sequence numbers from chats.last_seq.
+
+    The $inc on the chat document is atomic, so numbers stay unique and
+    consecutive across workers. Requests for a chat that arrive while its
+    counter update is in flight are queued and reserved together by the next
+    $inc, so a burst costs one round trip rather than one per message.
+
+    A number whose message then fails to store (a lost idempotency race, a
+    write error) is not reused; fill_seq_gaps() stores a placeholder under
+    it so seq-range reads still see every number.
+    """
+    
+    def __init__(self):
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._flushing: set = set()
+    
+    async def allocate(self, chat_id: str) -> int:
+        return (await self.allocate_many(chat_id, 1))[0]
+    
+    async def allocate_many(self, chat_id: str, count: int) -> List[int]:
+        """count consecutive numbers, reserved in the same $inc"""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in range(count)]
+        self._waiters.setdefault(chat_id, []).extend(futures)
+        if chat_id not in self._flushing:
+            self._flushing.add(chat_id)
+            asyncio.create_task(self._flush(chat_id))
+        return list(await asyncio.gather(*futures))
+    
+    async def _flush(self, chat_id: str):
+        try:
+            while self._waiters.get(chat_id):
+                waiters = self._waiters.pop(chat_id)
+                try:
+                    chat = await db.chats.find_one_and_update(
+                        {"id": chat_id},
+                        {"$inc": {"last_seq": len(waiters)}},
+                        projection={"last_seq": 1},
+                        return_document=ReturnDocument.AFTER
+                    )
+                    if chat is None:
+                        raise HTTPException(status_code=404, detail="Chat not found")
+                except Exception as e:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                
+                first = chat["last_seq"] - len(waiters) + 1
+                for offset, waiter in enumerate(waiters):
+                    if not waiter.done():
+                        waiter.set_result(first + offset)
+        finally:
+            self._flushing.discard(chat_id)
+
+seq_allocator = SequenceAllocator()
+
+async def fill_seq_gaps(chat_id: str, sender_id: str, seqs: List[int]):
+    """Store a deleted message_type "gap" placeholder under seqs whose
+    message could not be stored, so clients repairing gaps by seq range get
+    an answer for every number instead of retrying a hole forever"""
+    if not seqs:
+        return
+    placeholders = [
+        Message(chat_id=chat_id, seq=seq, sender_id=sender_id, content="", message_type="gap", is_deleted=True)
+        for seq in seqs
+    ]
+    try:
+        await db.messages.insert_many([p.model_dump() for p in placeholders], ordered=False)
+    except BulkWriteError as e:
+        # Duplicate seq: the write that seemed to fail did land after all
+        if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+            logger.error(f"Filling seq gaps {seqs} in chat {chat_id} failed: {e}")
+    except Exception as e:
+        logger.error(f"Filling seq gaps {seqs} in chat {chat_id} failed: {e}")
+
+# ===== CHANGE LOG =====
+
+# Log entries younger than this may still be overtaken by a slower writer
+# (ObjectIds are only ordered per process), so sync tokens never move past it
+CHANGE_LOG_SETTLE_SECONDS = 2
+
+async def record_change(kind: str, recipients: List[str], payload: Dict[str, Any], chat_id: Optional[str] = None):
+    """Append one change-log entry per recipient for /api/sync to replay"""
+    await record_changes([(kind, recipients, payload, chat_id)])
+
+async def record_changes(changes: List[Tuple[str, List[str], Dict[str, Any], Optional[str]]]):
+    """record_change for many (kind, recipients, payload, chat_id) in one insert"""
+    now = datetime.now(timezone.utc)
+    entries = []
+    for kind, recipients, payload, chat_id in changes:
+        payload = {k: v for k, v in payload.items() if k != "_id"}
+        entries.extend(
+            {"user_id": recipient, "kind": kind, "chat_id": chat_id, "payload": payload, "created_at": now}
+            for recipient in dict.fromkeys(recipients)
+        )
+    if entries:
+        await db.changes.insert_many(entries, ordered=False)
+
+# ===== READ RECEIPTS =====
+
+# One receipts document per (chat, user) holds the highest seq that user has
+# had delivered and has read, plus their unread counter for the chat. Message
+# status is derived from the watermarks instead of being written on every
+# message. Sending a message advances the sender's own watermarks, so every
+# message past read_seq is from someone else and last_seq - read_seq bounds
+# the unread counter.
+
+def _receipt_update(status: str, seq: int, last_seq: int, now: datetime):
+    if status == "delivered":
+        return {"$max": {"delivered_seq": seq}, "$set": {"delivered_at": now}}
+    read_seq = {"$max": [{"$ifNull": ["$read_seq", 0]}, seq]}
+    return [{"$set": {
+        "delivered_seq": {"$max": [{"$ifNull": ["$delivered_seq", 0]}, seq]},
+        "read_seq": read_seq,
+        "read_at": now,
+        "unread": {"$max": [0, {"$min": [{"$ifNull": ["$unread", 0]}, {"$subtract": [last_seq, read_seq]}]}]}
+    }}]
+
+async def record_sent(chat_id: str, sender_id: str, participants: List[str], seqs: List[int]):
+    """Bump everyone else's unread counter and mark the chat read for the sender, in one bulk write"""
+    top = max(seqs)
+    await db.receipts.bulk_write([
+        UpdateOne({"chat_id": chat_id, "user_id": p}, {"$inc": {"unread": len(seqs)}}, upsert=True)
+        for p in participants if p != sender_id
+    ] + [
+        UpdateOne(
+            {"chat_id": chat_id, "user_id": sender_id},
+            {"$max": {"delivered_seq": top, "read_seq": top}, "$set": {"unread": 0}},
+            upsert=True
+        )
+    ], ordered=False)
+
+async def unread_counts(user_id: str, chat_ids: List[str]) -> Dict[str, int]:
+    receipts = db.receipts.find({"user_id": user_id, "chat_id": {"$in": chat_ids}}, {"_id": 0, "chat_id": 1, "unread": 1})
+    return {r["chat_id"]: r.get("unread", 0) async for r in receipts}
+
+async def total_unread(user_id: str) -> int:
+    """Badge count: sum of the user's non-zero counters"""
+    result = await db.receipts.aggregate([
+        {"$match": {"user_id": user_id, "unread": {"$gt": 0}}},
+        {"$group": {"_id": None, "total": {"$sum": "$unread"}}}
+    ]).to_list(1)
+    return result[0]["total"] if result else 0
+
+async def acknowledge_messages(user_id: str, status: str, data: Dict[str, Any]):
+    """Advance user_id's watermarks from a (possibly batched) ack.
+
+    data may carry chat_id + seq ("everything up to seq"), message_ids, or the
+    legacy single message_id. Costs one write per chat touched and emits one
+    message_status event per chat.
+    """
+    marks: Dict[str, int] = {}
+    if data.get('chat_id') and data.get('seq') is not None:
+        marks[data['chat_id']] = int(data['seq'])
+    
+    message_ids = list(data.get('message_ids') or [])
+    if data.get('message_id'):
+        message_ids.append(data['message_id'])
+    acked_ids: Dict[str, List[str]] = {}
+    if message_ids:
+        async for message in db.messages.find({"id": {"$in": message_ids}}, {"_id": 0, "id": 1, "chat_id": 1, "seq": 1}):
+            acked_ids.setdefault(message["chat_id"], []).append(message["id"])
+            if message.get("seq") is not None:
+                marks[message["chat_id"]] = max(marks.get(message["chat_id"], 0), message["seq"])
+    if not marks:
+        return
+    
+    # Only chats the user belongs to, and never past what has been allocated
+    chats = await db.chats.find(
+        {"id": {"$in": list(marks)}, "participants": user_id},
+        {"_id": 0, "id": 1, "last_seq": 1}
+    ).to_list(None)
+    last_seqs = {chat["id"]: chat.get("last_seq", 0) for chat in chats}
+    marks = {chat_id: min(marks[chat_id], last_seq) for chat_id, last_seq in last_seqs.items()}
+    if not marks:
+        return
+    
+    now = datetime.now(timezone.utc)
+    await db.receipts.bulk_write([
+        UpdateOne(
+            {"chat_id": chat_id, "user_id": user_id},
+            _receipt_update(status, seq, last_seqs[chat_id], now),
+            upsert=True
+        )
+        for chat_id, seq in marks.items()
+    ], ordered=False)
+    
+    for chat_id, seq in marks.items():
+        await sio.emit('message_status', {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "status": status,
+            "seq": seq,
+            "message_ids": acked_ids.get(chat_id, [])
+        }, room=chat_id)
+
+async def apply_receipt_status(chat_id: str, messages: List[Dict[str, Any]]):
+    """Set each sequenced message's status from the other participants' watermarks"""
+    if not any(m.get("seq") is not None for m in messages):
+        return
+    participants = await chat_participants(chat_id)
+    receipts = {r["user_id"]: r async for r in db.receipts.find({"chat_id": chat_id}, {"_id": 0})}
+    
+    # Lowest watermark among everyone but the sender, per sender
+    floors: Dict[str, Dict[str, int]] = {}
+    for message in messages:
+        if message.get("seq") is None:
+            continue
+        sender = message["sender_id"]
+        if sender not in floors:
+            others = [receipts.get(p, {}) for p in participants if p != sender]
+            floors[sender] = {
+                field: min((r.get(field, 0) for r in others), default=0)
+                for field in ("delivered_seq", "read_seq")
+            }
+        floor = floors[sender]
+        if floor["read_seq"] >= message["seq"]:
+            message["status"] = "read"
+        elif floor["delivered_seq"] >= message["seq"]:
+            message["status"] = "delivered"
+        else:
+            message["status"] = "sent"
+
+# ===== CACHES =====
+
+class AsyncTTLCache:
+    """Bounded in-process cache with LRU eviction, per-entry TTL and single-flight loads.
+
+    Concurrent misses on the same key share one loader call. A key invalidated
+    while its load is in flight is not cached from that load, so a write
+    followed by invalidate() never leaves the pre-write value behind.
+
+    max_size bounds the summed weigher() of the entries; by default every
+    entry weighs 1, so it is an entry count.
+    """
+    
+    def __init__(self, loader, many_loader=None, max_size: int = 10000, ttl: float = 60.0, weigher=None):
+        self._loader = loader
+        self._many_loader = many_loader
+        self._max_size = max_size
+        self._ttl = ttl
+        self._weigher = weigher or (lambda value: 1)
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, value, weight)
+        self._weight = 0
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self._stale: set = set()
+        self.hits = self.misses = self.loads = self.evictions = 0
+    
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._weight -= entry[2]
+    
+    def _store(self, key, value):
+        if key in self._stale:
+            self._stale.discard(key)
+            return
+        self.put(key, value)
+    
+    def peek(self, key):
+        """The cached value, if any, without loading, counting a hit or refreshing its LRU position"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+    
+    def put(self, key, value):
+        """Cache a value the caller knows to be current, e.g. right after writing it"""
+        if value is None:
+            return
+        weight = self._weigher(value)
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + self._ttl, value, weight)
+        self._weight += weight
+        while self._weight > self._max_size and self._entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+    
+    async def get(self, key):
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        
+        if key in self._inflight:
+            return await self._wait(key, self._inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self.loads += 1
+            value = await self._loader(key)
+            self._store(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # don't warn when nobody else was waiting
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            self._stale.discard(key)
+            if not future.done():
+                # This caller was cancelled mid-load; waiters load again
+                future.cancel()
+    
+    async def _wait(self, key, future: asyncio.Future):
+        """Await another caller's load of key, loading it again if that caller was cancelled"""
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if future.cancelled() and not asyncio.current_task().cancelling():
+                return await self.get(key)
+            raise
+    
+    async def get_many(self, keys: List[Any]) -> Dict[Any, Any]:
+        """Values for keys that exist; all misses are loaded with one many_loader call"""
+        found = {}
+        missing = []
+        waiting = {}
+        for key in dict.fromkeys(keys):
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                found[key] = entry[1]
+            elif key in self._inflight:
+                self.misses += 1
+                waiting[key] = self._inflight[key]
+            else:
+                self.misses += 1
+                missing.append(key)
+        
+        if missing:
+            futures = {key: asyncio.get_running_loop().create_future() for key in missing}
+            self._inflight.update(futures)
+            try:
+                self.loads += 1
+                loaded = await self._many_loader(missing)
+                for key, future in futures.items():
+                    value = loaded.get(key)
+                    self._store(key, value)
+                    future.set_result(value)
+                    if value is not None:
+                        found[key] = value
+            except Exception as e:
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+                        future.exception()
+                raise
+            finally:
+                for key, future in futures.items():
+                    self._inflight.pop(key, None)
+                    if not future.done():
+                        future.cancel()
+                self._stale.difference_update(missing)
+        
+        for key, future in waiting.items():
+            value = await self._wait(key, future)
+            if value is not None:
+                found[key] = value
+        return found
+    
+    def invalidate(self, key):
+        self._drop(key)
+        if key in self._inflight:
+            self._stale.add(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "weight": self._weight,
+            "max_size": self._max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "loads": self.loads,
+            "evictions": self.evictions
+        }
+
+async def _load_user(user_id: str) -> Optional[User]:
+    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+    return User(**user_doc) if user_doc else None
+
+async def _load_users(user_ids: List[str]) -> Dict[str, User]:
+    users = await db.users.find({"id": {"$in": user_ids}}, {"_id": 0}).to_list(None)
+    return {u["id"]: User(**u) for u in users}
+
+# Cached User models; treat them as read-only. Anything that writes a user
+# document must call user_cache.invalidate(user_id).
+user_cache = AsyncTTLCache(
+    _load_user,
+    _load_users,
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 60))
+)
+
+async def _load_members(chat_id: str) -> Optional[frozenset]:
+    chat = await db.chats.find_one({"id": chat_id}, {"_id": 0, "participants": 1})
+    return frozenset(chat["participants"]) if chat else None
+
+async def _load_members_many(chat_ids: List[str]) -> Dict[str, frozenset]:
+    chats = await db.chats.find({"id": {"$in": chat_ids}}, {"_id": 0, "id": 1, "participants": 1}).to_list(None)
+    return {c["id"]: frozenset(c["participants"]) for c in chats}
+
+# Participant sets per chat for authorization and fan-out. Weighed by member
+# count so CHAT_MEMBERS_CACHE_MAX_IDS caps the ids held, not the chats. Code
+# that changes chats.participants must call chat_members.invalidate(chat_id)
+# (or put() the new set).
+chat_members = AsyncTTLCache(
+    _load_members,
+    _load_members_many,
+    max_size=int(os.environ.get('CHAT_MEMBERS_CACHE_MAX_IDS', 1_000_000)),
+    ttl=float(os.environ.get('CHAT_MEMBERS_CACHE_TTL', 300)),
+    weigher=len
+)
+
+async def chat_participants(chat_id: str) -> List[str]:
+    members = await chat_members.get(chat_id)
+    return list(members) if members else []
+
+async def is_chat_member(chat_id: str, user_id: str) -> bool:
+    members = await chat_members.get(chat_id)
+    return members is not None and user_id in members
+
+# ===== ACTIVITY WRITE-BEHIND =====
+
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_FLUSH_SECONDS', 5))
+
+class ActivityBuffer:
+    """Write-behind buffer for users.last_seen and devices.last_active.
+
+    touch() only records the latest timestamp per user and device in memory.
+    Every ACTIVITY_FLUSH_SECONDS the buffer is written with one unordered
+    bulk_write per collection, so a reconnect storm costs one write per user
+    per interval instead of one per socket event. Writes use $max, so a late
+    flush never moves a timestamp backwards and a retried batch is harmless.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._users: Dict[str, datetime] = {}
+        self._devices: Dict[str, datetime] = {}
+        self.touches = 0
+        self.flushes = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._flush_ms_total = 0.0
+
+    def touch(self, user_id: str, device_id: Optional[str] = None):
+        now = datetime.now(timezone.utc)
+        self.touches += 1
+        self._users[user_id] = now
+        if device_id:
+            self._devices[device_id] = now
+
+    async def flush(self):
+        if not self._users and not self._devices:
+            return
+        users, self._users = self._users, {}
+        devices, self._devices = self._devices, {}
+        start = time.perf_counter()
+        try:
+            writes = []
+            if users:
+                writes.append(db.users.bulk_write([
+                    UpdateOne({"id": user_id}, {"$max": {"last_seen": seen}}) for user_id, seen in users.items()
+                ], ordered=False))
+            if devices:
+                writes.append(db.devices.bulk_write([
+                    UpdateOne({"id": device_id}, {"$max": {"last_active": seen}}) for device_id, seen in devices.items()
+                ], ordered=False))
+            await asyncio.gather(*writes)
+        except BaseException:
+            # Put the batch back (keeping anything newer) for the next flush
+            for buffered, batch in ((self._users, users), (self._devices, devices)):
+                for key, seen in batch.items():
+                    if key not in buffered or buffered[key] < seen:
+                        buffered[key] = seen
+            raise
+        # Bring cached profiles along instead of evicting the most active users
+        for user_id, seen in users.items():
+            user = user_cache.peek(user_id)
+            if user is not None and as_utc(user.last_seen) < seen:
+                user.last_seen = seen
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        batch_size = len(users) + len(devices)
+        self.flushes += 1
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._flush_ms_total += elapsed_ms
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Activity flush failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_users": len(self._users),
+            "pending_devices": len(self._devices),
+            "touches": self.touches,
+            "flushes": self.flushes,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "avg_flush_ms": round(self._flush_ms_total / self.flushes, 3) if self.flushes else 0.0
+        }
+
+# last_seen/last_active in the database (and user_cache) may trail by up to
+# ACTIVITY_FLUSH_SECONDS.
+activity_buffer = ActivityBuffer(ACTIVITY_FLUSH_SECONDS)
+
 # ===== HELPER FUNCTIONS =====
 
 def generate_otp():
@@ -206,21 +1193,71 @@ def validate_phone_number(phone: str) -> bool:
         return False
 
 async def get_user_by_id(user_id: str) -> Optional[User]:
-    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if user_doc:
-        if isinstance(user_doc.get('created_at'), str):
-            user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
-        if isinstance(user_doc.get('last_seen'), str):
-            user_doc['last_seen'] = datetime.fromisoformat(user_doc['last_seen'])
-        return User(**user_doc)
-    return None
-
-async def update_last_seen(user_id: str):
-    await db.users.update_one(
-        {"id": user_id},
-        {"$set": {"last_seen": datetime.now(timezone.utc).isoformat()}}
+    return await user_cache.get(user_id)
+
+LAST_MESSAGE_PREVIEW_CHARS = 200
+
+def message_preview(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact summary of a message, stored on its chat as last_message"""
+    return {
+        "id": message["id"],
+        "seq": message.get("seq"),
+        "sender_id": message["sender_id"],
+        "content": message["content"][:LAST_MESSAGE_PREVIEW_CHARS],
+        "message_type": message["message_type"],
+        "is_edited": message.get("is_edited", False),
+        "created_at": message["created_at"]
+    }
+
+async def refresh_last_message(chat_id: str):
+    """Recompute a chat's last_message from the newest message still visible"""
+    last_message = await db.messages.find_one(
+        {"chat_id": chat_id, "is_deleted": False},
+        {"_id": 0},
+        sort=[("created_at", -1)]
+    )
+    await db.chats.update_one(
+        {"id": chat_id},
+        {"$set": {"last_message": message_preview(last_message) if last_message else None}}
     )
 
+def encode_cursor(*values: Any) -> str:
+    """Opaque pagination cursor for a keyset position"""
+    return base64.urlsafe_b64encode(SocketJSON.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def decode_keyset_cursor(cursor: str) -> Tuple[datetime, str]:
+    """(timestamp, id) position from a cursor made by encode_cursor"""
+    value, last_id = decode_cursor(cursor, 2)
+    if not isinstance(value, str) or not isinstance(last_id, str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    try:
+        return as_utc(value), last_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(field: str, value: Any, last_id: str, op: str) -> Dict[str, Any]:
+    """Match documents strictly before ("$lt") or after ("$gt") the (field, id) position.
+
+    The inclusive bound on field alone lets the planner walk a (..., field, id)
+    index range instead of unioning the two $or branches.
+    """
+    return {
+        field: {op + "e": value},
+        "$or": [
+            {field: {op: value}},
+            {field: value, "id": {op: last_id}}
+        ]
+    }
+
 # ===== AUTH ENDPOINTS =====
 
 @api_router.post("/auth/request-otp")
@@ -237,8 +1274,8 @@ async def request_otp(data: OTPRequest):
         "phone_number": data.phone_number,
         "email": data.email,
         "otp": otp,
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat()
+        "created_at": datetime.now(timezone.utc),
+        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=10)
     }
     await db.otps.insert_one(otp_doc)
     
@@ -259,7 +1296,7 @@ async def verify_otp(data: OTPVerify):
     if not otp_doc or otp_doc["otp"] != data.otp:
         raise HTTPException(status_code=400, detail="Invalid OTP")
     
-    expires_at = datetime.fromisoformat(otp_doc["expires_at"])
+    expires_at = as_utc(otp_doc["expires_at"])
     if datetime.now(timezone.utc) > expires_at:
         raise HTTPException(status_code=400, detail="OTP expired")
     
@@ -284,10 +1321,15 @@ async def verify_otp(data: OTPVerify):
             display_name=data.phone_number or data.email or "User",
             username=f"user_{str(uuid.uuid4())[:8]}"
         )
-        user_dict = user.model_dump()
-        user_dict['created_at'] = user_dict['created_at'].isoformat()
-        user_dict['last_seen'] = user_dict['last_seen'].isoformat()
-        await db.users.insert_one(user_dict)
+        try:
+            await db.users.insert_one(user.model_dump())
+        except DuplicateKeyError:
+            # A concurrent first login for the same number or email won
+            user_doc = await db.users.find_one(user_query, {"_id": 0})
+            if not user_doc:
+                raise
+            is_new_user = False
+            user = User(**user_doc)
     
     # Create device
     device = Device(
@@ -296,13 +1338,11 @@ async def verify_otp(data: OTPVerify):
         device_type=data.device_type,
         public_key=data.public_key
     )
-    device_dict = device.model_dump()
-    device_dict['created_at'] = device_dict['created_at'].isoformat()
-    device_dict['last_active'] = device_dict['last_active'].isoformat()
-    await db.devices.insert_one(device_dict)
+    await db.devices.insert_one(device.model_dump())
     
     # Delete OTP
     await db.otps.delete_one({"_id": otp_doc["_id"]})
+    user_cache.invalidate(user.id)
     
     return {
         "user": user.model_dump(),
@@ -325,24 +1365,42 @@ async def update_user(user_id: str, updates: Dict[str, Any]):
     allowed_fields = ["display_name", "about", "avatar_url", "username", "privacy_settings"]
     update_data = {k: v for k, v in updates.items() if k in allowed_fields}
     
-    if update_data:
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": update_data}
+    if "avatar_url" in update_data:
+        avatar_url = update_data["avatar_url"]
+        update_data["avatar_media_ids"] = (
+            await reference_media(user_id, [{"url": avatar_url}]) if isinstance(avatar_url, str) else []
         )
     
+    if update_data:
+        try:
+            previous = await db.users.find_one_and_update(
+                {"id": user_id},
+                {"$set": update_data},
+                projection={"_id": 0, "avatar_media_ids": 1}
+            )
+        except DuplicateKeyError:
+            await release_media(update_data.get("avatar_media_ids", []))
+            raise HTTPException(status_code=409, detail="Username already taken")
+        user_cache.invalidate(user_id)
+        if "avatar_media_ids" in update_data:
+            # The replaced avatar gives its reference back; so does the new one if there was no user
+            await release_media(previous.get("avatar_media_ids", []) if previous else update_data["avatar_media_ids"])
+    
     return await get_user_by_id(user_id)
 
 @api_router.get("/users/search")
 async def search_users(query: str):
-    users = await db.users.find({
+    # Only ids come back from the scan; profiles are served from the cache
+    matches = await db.users.find({
         "$or": [
             {"username": {"$regex": query, "$options": "i"}},
             {"phone_number": {"$regex": query}},
             {"display_name": {"$regex": query, "$options": "i"}}
         ]
-    }, {"_id": 0}).to_list(20)
-    return users
+    }, {"_id": 0, "id": 1}).to_list(20)
+    user_ids = [m["id"] for m in matches]
+    users = await user_cache.get_many(user_ids)
+    return [users[uid] for uid in user_ids if uid in users]
 
 # ===== CONTACT ENDPOINTS =====
 
@@ -369,9 +1427,11 @@ async def add_contact(user_id: str, contact_data: ContactAdd):
         return {"message": "Contact already exists"}
     
     contact = Contact(user_id=user_id, contact_user_id=contact_user["id"])
-    contact_dict = contact.model_dump()
-    contact_dict['created_at'] = contact_dict['created_at'].isoformat()
-    await db.contacts.insert_one(contact_dict)
+    try:
+        await db.contacts.insert_one(contact.model_dump())
+    except DuplicateKeyError:
+        # Added by a concurrent request since the check above
+        return {"message": "Contact already exists"}
     
     return contact
 
@@ -381,9 +1441,7 @@ async def get_contacts(user_id: str):
     
     # Get user details for each contact
     contact_ids = [c["contact_user_id"] for c in contacts]
-    users = await db.users.find({"id": {"$in": contact_ids}}, {"_id": 0}).to_list(1000)
-    
-    user_map = {u["id"]: u for u in users}
+    user_map = await user_cache.get_many(contact_ids)
     
     result = []
     for contact in contacts:
@@ -428,81 +1486,337 @@ async def create_chat(user_id: str, chat_data: ChatCreate):
             invite_link=f"wa://{str(uuid.uuid4())[:8]}"
         )
     
-    chat_dict = chat.model_dump()
-    chat_dict['created_at'] = chat_dict['created_at'].isoformat()
-    chat_dict['updated_at'] = chat_dict['updated_at'].isoformat()
-    await db.chats.insert_one(chat_dict)
+    await db.chats.insert_one(chat.model_dump())
+    chat_members.put(chat.id, frozenset(chat.participants))
+    await record_change("chat_created", chat.participants, chat.model_dump(), chat_id=chat.id)
     
     return chat
 
 @api_router.get("/chats")
-async def get_chats(user_id: str):
-    chats = await db.chats.find(
-        {"participants": user_id},
-        {"_id": 0}
-    ).to_list(1000)
+async def get_chats(user_id: str, limit: int = 50, cursor: Optional[str] = None):
+    """Inbox, most recently active chat first.
+
+    last_message is kept on the chat by the message endpoints and unread comes
+    from the materialized receipts counters, so nothing here reads messages.
+    """
+    limit = max(1, min(limit, 200))
+    query: Dict[str, Any] = {"participants": user_id}
+    if cursor:
+        updated_at, chat_id = decode_keyset_cursor(cursor)
+        query.update(keyset_filter("updated_at", updated_at, chat_id, "$lt"))
+    
+    chats = await db.chats.find(query, {"_id": 0}).sort(
+        [("updated_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
     
-    # Get last message for each chat
+    next_cursor = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        next_cursor = encode_cursor(chats[-1]["updated_at"], chats[-1]["id"])
+    
+    unread = await unread_counts(user_id, [chat["id"] for chat in chats])
     for chat in chats:
-        last_message = await db.messages.find_one(
-            {"chat_id": chat["id"], "is_deleted": False},
-            {"_id": 0},
-            sort=[("created_at", -1)]
-        )
-        chat["last_message"] = last_message
+        chat["unread"] = unread.get(chat["id"], 0)
     
-    return chats
+    return {"chats": chats, "next_cursor": next_cursor, "total_unread": await total_unread(user_id)}
 
 @api_router.get("/chats/{chat_id}/messages")
-async def get_messages(chat_id: str, user_id: str, limit: int = 50, before: Optional[str] = None):
-    query = {
+async def get_messages(chat_id: str, user_id: str, limit: int = 50,
+                       before: Optional[str] = None, after: Optional[str] = None,
+                       from_seq: Optional[int] = None, to_seq: Optional[int] = None):
+    """Keyset-paginated history in chronological order.
+
+    Without a cursor the newest page is returned. Pass prev_cursor as before to
+    scroll back and next_cursor as after to catch up; either is None at the
+    respective end of the history.
+
+    from_seq/to_seq fetch an inclusive seq range instead, for clients filling a
+    gap after reconnecting; page on by asking again from the last seq + 1.
+    Every allocated seq is answered: deleted messages come back with
+    is_deleted, and seqs whose send failed as message_type "gap".
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    limit = max(1, min(limit, 200))
+    
+    if from_seq is not None or to_seq is not None:
+        if before or after:
+            raise HTTPException(status_code=400, detail="Seq range cannot be combined with a cursor")
+        # Messages deleted for everyone are kept so the range has no holes
+        seq_range: Dict[str, int] = {"$gte": max(from_seq or 1, 1)}
+        if to_seq is not None:
+            seq_range["$lte"] = to_seq
+        messages = await db.messages.find(
+            {"chat_id": chat_id, "deleted_for": {"$ne": user_id}, "seq": seq_range},
+            {"_id": 0}
+        ).sort("seq", 1).limit(limit).to_list(limit)
+        await apply_receipt_status(chat_id, messages)
+        return {"messages": messages, "prev_cursor": None, "next_cursor": None}
+    
+    # is_deleted / deleted_for are checked on the fetched documents; the index
+    # walk itself is bounded by the page size
+    query: Dict[str, Any] = {
         "chat_id": chat_id,
         "is_deleted": False,
         "deleted_for": {"$ne": user_id}
     }
     
-    if before:
-        before_date = datetime.fromisoformat(before)
-        query["created_at"] = {"$lt": before_date.isoformat()}
+    if after:
+        created_at, message_id = decode_keyset_cursor(after)
+        query.update(keyset_filter("created_at", created_at, message_id, "$gt"))
+        sort = [("created_at", 1), ("id", 1)]
+    else:
+        if before:
+            created_at, message_id = decode_keyset_cursor(before)
+            query.update(keyset_filter("created_at", created_at, message_id, "$lt"))
+        sort = [("created_at", -1), ("id", -1)]
+    
+    messages = await db.messages.find(query, {"_id": 0}).sort(sort).limit(limit + 1).to_list(limit + 1)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after:
+        messages.reverse()
+    await apply_receipt_status(chat_id, messages)
     
-    messages = await db.messages.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
-    messages.reverse()
+    has_older = has_more if not after else True
+    has_newer = has_more if after else bool(before)
+    prev_cursor = next_cursor = None
+    if messages:
+        if has_older:
+            prev_cursor = encode_cursor(messages[0]["created_at"], messages[0]["id"])
+        if has_newer:
+            next_cursor = encode_cursor(messages[-1]["created_at"], messages[-1]["id"])
     
-    return messages
+    return {"messages": messages, "prev_cursor": prev_cursor, "next_cursor": next_cursor}
 
 # ===== MESSAGE ENDPOINTS =====
 
+async def find_client_message(chat_id: str, sender_id: str, client_message_id: Optional[str]) -> Optional[Message]:
+    if not client_message_id:
+        return None
+    doc = await db.messages.find_one(
+        {"chat_id": chat_id, "sender_id": sender_id, "client_message_id": client_message_id},
+        {"_id": 0}
+    )
+    return Message(**doc) if doc else None
+
 @api_router.post("/messages")
 async def send_message(user_id: str, message_data: MessageCreate):
+    return await create_message(user_id, message_data)
+
+async def create_message(user_id: str, message_data: MessageCreate, skip_sid: Optional[str] = None) -> Message:
+    """Authorize, store and fan out one message; shared by HTTP and socket sends"""
     # Verify user is in chat
-    chat = await db.chats.find_one({"id": message_data.chat_id}, {"_id": 0})
-    if not chat or user_id not in chat["participants"]:
+    members = await chat_members.get(message_data.chat_id)
+    if not members or user_id not in members:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    message = Message(
-        chat_id=message_data.chat_id,
-        sender_id=user_id,
-        content=message_data.content,
-        message_type=message_data.message_type,
-        reply_to=message_data.reply_to,
-        attachments=message_data.attachments
-    )
+    # A retry of a send that already landed gets the stored message back
+    if message_data.client_message_id:
+        existing = await find_client_message(message_data.chat_id, user_id, message_data.client_message_id)
+        if existing:
+            return existing
     
-    message_dict = message.model_dump()
-    message_dict['created_at'] = message_dict['created_at'].isoformat()
-    await db.messages.insert_one(message_dict)
+    media_ids = await reference_media(user_id, message_data.attachments)
+    seq = None
+    try:
+        seq = await seq_allocator.allocate(message_data.chat_id)
+        message = Message(
+            chat_id=message_data.chat_id,
+            seq=seq,
+            sender_id=user_id,
+            client_message_id=message_data.client_message_id,
+            content=message_data.content,
+            message_type=message_data.message_type,
+            reply_to=message_data.reply_to,
+            attachments=message_data.attachments,
+            media_ids=media_ids
+        )
+        message_dict = message.model_dump()
+        await db.messages.insert_one(message_dict)
+    except BaseException as e:
+        await release_media(media_ids)
+        if seq is not None:
+            await fill_seq_gaps(message_data.chat_id, user_id, [seq])
+        if not isinstance(e, DuplicateKeyError):
+            raise
+        # Lost a race with a concurrent retry; its message wins
+        existing = await find_client_message(message_data.chat_id, user_id, message_data.client_message_id)
+        if not existing:
+            raise
+        return existing
     
-    # Update chat updated_at
+    # Move the chat to the top of the inbox
     await db.chats.update_one(
         {"id": message_data.chat_id},
-        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {
+            "updated_at": message_dict['created_at'],
+            "last_message": message_preview(message_dict)
+        }}
     )
     
-    # Emit via Socket.IO
-    await sio.emit('new_message', message.model_dump(), room=message_data.chat_id)
+    await record_sent(message.chat_id, user_id, members, [message.seq])
+    await record_change("message_new", list(members), message.model_dump(), chat_id=message.chat_id)
+    
+    # Emit via Socket.IO; a socket sender gets the message in its ack instead
+    await sio.emit('new_message', message.model_dump(), room=message_data.chat_id, skip_sid=skip_sid)
     
     return message
 
+MESSAGE_BATCH_MAX = int(os.environ.get('MESSAGE_BATCH_MAX', 500))
+
+@api_router.post("/messages/batch")
+async def send_messages_batch(user_id: str, batch: MessageBatchCreate):
+    """Send many messages, across any number of chats, in one request.
+
+    Membership is checked once per distinct chat, messages are written with
+    one insert_many and one grouped chat update, and each room gets a single
+    `new_messages` event. Returns one result per item, in request order:
+    {"status": 200, "message": ...} or {"status": 4xx/5xx, "detail": ...}; an
+    item that fails validation gets 422 without failing the rest.
+    client_message_id behaves as in send_message.
+    """
+    if len(batch.messages) > MESSAGE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {MESSAGE_BATCH_MAX} messages per batch")
+    
+    results: List[Optional[Dict[str, Any]]] = [None] * len(batch.messages)
+    items: Dict[int, MessageCreate] = {}
+    for index, raw in enumerate(batch.messages):
+        try:
+            items[index] = MessageCreate.model_validate(raw)
+        except ValidationError as e:
+            results[index] = {"status": 422, "detail": e.errors(include_url=False, include_context=False)}
+    members = await chat_members.get_many([item.chat_id for item in items.values()])
+    
+    # Items already stored under their client_message_id, or repeating an
+    # earlier item's key, resolve to that message instead of a new one
+    keys = {item.client_message_id for item in items.values() if item.client_message_id}
+    stored: Dict[Tuple[str, str], Message] = {}
+    if keys:
+        existing = db.messages.find({
+            "chat_id": {"$in": list(members)}, "sender_id": user_id, "client_message_id": {"$in": list(keys)}
+        }, {"_id": 0})
+        async for doc in existing:
+            stored[(doc["chat_id"], doc["client_message_id"])] = Message(**doc)
+    
+    by_chat: Dict[str, List[int]] = {}
+    first_index: Dict[Tuple[str, str], int] = {}
+    repeats: List[Tuple[int, int]] = []
+    for index, item in items.items():
+        key = (item.chat_id, item.client_message_id)
+        if user_id not in members.get(item.chat_id, ()):
+            results[index] = {"status": 403, "detail": "Not authorized"}
+        elif key in stored:
+            results[index] = {"status": 200, "message": stored[key]}
+        elif item.client_message_id and key in first_index:
+            repeats.append((index, first_index[key]))
+        else:
+            if item.client_message_id:
+                first_index[key] = index
+            by_chat.setdefault(item.chat_id, []).append(index)
+    
+    media_ids: Dict[int, List[str]] = {}
+    for chat_id, indexes in list(by_chat.items()):
+        references = await asyncio.gather(
+            *(reference_media(user_id, items[index].attachments) for index in indexes), return_exceptions=True
+        )
+        for index, reference in zip(indexes, references):
+            if isinstance(reference, HTTPException):
+                results[index] = {"status": reference.status_code, "detail": reference.detail}
+            elif isinstance(reference, BaseException):
+                results[index] = {"status": 500, "detail": "Send failed"}
+            else:
+                media_ids[index] = reference
+        by_chat[chat_id] = [index for index in indexes if index in media_ids]
+        if not by_chat[chat_id]:
+            del by_chat[chat_id]
+    
+    chat_ids = list(by_chat)
+    allocations = await asyncio.gather(
+        *(seq_allocator.allocate_many(chat_id, len(by_chat[chat_id])) for chat_id in chat_ids),
+        return_exceptions=True
+    )
+    messages: Dict[int, Message] = {}
+    for chat_id, seqs in zip(chat_ids, allocations):
+        if isinstance(seqs, BaseException):
+            error = seqs if isinstance(seqs, HTTPException) else HTTPException(status_code=500, detail="Send failed")
+            for index in by_chat[chat_id]:
+                results[index] = {"status": error.status_code, "detail": error.detail}
+                await release_media(media_ids[index])
+            continue
+        for index, seq in zip(by_chat[chat_id], seqs):
+            item = items[index]
+            messages[index] = Message(
+                chat_id=chat_id,
+                seq=seq,
+                sender_id=user_id,
+                client_message_id=item.client_message_id,
+                content=item.content,
+                message_type=item.message_type,
+                reply_to=item.reply_to,
+                attachments=item.attachments,
+                media_ids=media_ids[index]
+            )
+    
+    order = list(messages)
+    failed: Dict[int, int] = {}  # item index -> error code
+    if order:
+        try:
+            await db.messages.insert_many([messages[i].model_dump() for i in order], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed[order[error["index"]]] = error["code"]
+        except BaseException:
+            failed = {index: 0 for index in order}
+            raise
+        finally:
+            burned: Dict[str, List[int]] = {}
+            for index in failed:
+                await release_media(messages[index].media_ids)
+                burned.setdefault(messages[index].chat_id, []).append(messages[index].seq)
+            for chat_id, seqs in burned.items():
+                await fill_seq_gaps(chat_id, user_id, seqs)
+    
+    sent: Dict[str, List[Message]] = {}
+    for index in order:
+        message = messages[index]
+        if index not in failed:
+            results[index] = {"status": 200, "message": message}
+            sent.setdefault(message.chat_id, []).append(message)
+        elif failed[index] == 11000 and message.client_message_id:
+            # Lost a race with a concurrent retry; its message wins
+            winner = await find_client_message(message.chat_id, user_id, message.client_message_id)
+            results[index] = {"status": 200, "message": winner} if winner else {"status": 409, "detail": "Conflict"}
+        else:
+            results[index] = {"status": 500, "detail": "Send failed"}
+    for index, first in repeats:
+        results[index] = results[first]
+    
+    if sent:
+        # Move each chat to the top of the inbox with its newest message
+        await db.chats.bulk_write([
+            UpdateOne({"id": chat_id}, {"$set": {
+                "updated_at": chat_messages[-1].created_at,
+                "last_message": message_preview(chat_messages[-1].model_dump())
+            }})
+            for chat_id, chat_messages in sent.items()
+        ], ordered=False)
+        await asyncio.gather(*(
+            record_sent(chat_id, user_id, members[chat_id], [m.seq for m in chat_messages])
+            for chat_id, chat_messages in sent.items()
+        ))
+        await record_changes([
+            ("message_new", list(members[m.chat_id]), m.model_dump(), m.chat_id)
+            for chat_messages in sent.values() for m in chat_messages
+        ])
+        for chat_id, chat_messages in sent.items():
+            await sio.emit('new_messages', {
+                "chat_id": chat_id,
+                "messages": [m.model_dump() for m in chat_messages]
+            }, room=chat_id)
+    
+    return {"results": results}
+
 @api_router.patch("/messages/{message_id}")
 async def update_message(message_id: str, user_id: str, updates: Dict[str, Any]):
     message = await db.messages.find_one({"id": message_id}, {"_id": 0})
@@ -511,13 +1825,19 @@ async def update_message(message_id: str, user_id: str, updates: Dict[str, Any])
     
     allowed_fields = ["content", "is_edited"]
     update_data = {k: v for k, v in updates.items() if k in allowed_fields}
-    update_data["edited_at"] = datetime.now(timezone.utc).isoformat()
+    update_data["edited_at"] = datetime.now(timezone.utc)
     update_data["is_edited"] = True
     
     await db.messages.update_one({"id": message_id}, {"$set": update_data})
     
     # Emit update
     updated_message = await db.messages.find_one({"id": message_id}, {"_id": 0})
+    await db.chats.update_one(
+        {"id": message["chat_id"], "last_message.id": message_id},
+        {"$set": {"last_message": message_preview(updated_message)}}
+    )
+    await record_change("message_updated", await chat_participants(message["chat_id"]), updated_message,
+                        chat_id=message["chat_id"])
     await sio.emit('message_updated', updated_message, room=message["chat_id"])
     
     return updated_message
@@ -533,15 +1853,24 @@ async def delete_message(message_id: str, user_id: str, delete_for_everyone: boo
             raise HTTPException(status_code=403, detail="Not authorized")
         
         # Check time limit (5 minutes)
-        created_at = datetime.fromisoformat(message["created_at"])
+        created_at = as_utc(message["created_at"])
         if datetime.now(timezone.utc) - created_at > timedelta(minutes=5):
             raise HTTPException(status_code=400, detail="Time limit exceeded")
         
-        await db.messages.update_one(
-            {"id": message_id},
-            {"$set": {"is_deleted": True, "content": "This message was deleted"}}
+        result = await db.messages.update_one(
+            {"id": message_id, "is_deleted": {"$ne": True}},
+            {"$set": {"is_deleted": True, "content": "This message was deleted", "attachments": []}}
         )
+        # Only the delete that actually happened gives up the attachments
+        if result.modified_count:
+            await release_media(message.get("media_ids", []))
+        
+        chat = await db.chats.find_one({"id": message["chat_id"]}, {"_id": 0, "last_message": 1})
+        if chat and (chat.get("last_message") or {}).get("id") == message_id:
+            await refresh_last_message(message["chat_id"])
         
+        await record_change("message_deleted", await chat_participants(message["chat_id"]),
+                            {"message_id": message_id, "for_everyone": True}, chat_id=message["chat_id"])
         await sio.emit('message_deleted', {"message_id": message_id, "for_everyone": True}, room=message["chat_id"])
     else:
         # Delete for me only
@@ -549,6 +1878,8 @@ async def delete_message(message_id: str, user_id: str, delete_for_everyone: boo
             {"id": message_id},
             {"$addToSet": {"deleted_for": user_id}}
         )
+        await record_change("message_deleted", [user_id], {"message_id": message_id, "for_everyone": False},
+                            chat_id=message["chat_id"])
     
     return {"message": "Message deleted"}
 
@@ -565,75 +1896,911 @@ async def react_to_message(message_id: str, user_id: str, emoji: str):
     )
     
     # Add new reaction
-    reaction = {"user_id": user_id, "emoji": emoji, "created_at": datetime.now(timezone.utc).isoformat()}
+    reaction = {"user_id": user_id, "emoji": emoji, "created_at": datetime.now(timezone.utc)}
     await db.messages.update_one(
         {"id": message_id},
         {"$push": {"reactions": reaction}}
     )
     
     updated_message = await db.messages.find_one({"id": message_id}, {"_id": 0})
+    await record_change("message_reaction", await chat_participants(message["chat_id"]), updated_message,
+                        chat_id=message["chat_id"])
     await sio.emit('message_reaction', updated_message, room=message["chat_id"])
     
     return updated_message
 
+# ===== MEDIA WORKERS =====
+
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+MEDIA_QUEUE_DEPTH = int(os.environ.get('MEDIA_QUEUE_DEPTH', 4 * max(1, MEDIA_WORKERS)))
+MEDIA_QUEUE_TIMEOUT = float(os.environ.get('MEDIA_QUEUE_TIMEOUT', 10))
+
+class MediaPipeline:
+    """Bounded process pool for CPU-heavy media jobs (functions in media.py).
+
+    Jobs run in MEDIA_WORKERS spawned processes so image decoding never
+    stalls the event loop. At most MEDIA_QUEUE_DEPTH jobs are queued or
+    running; past that, run() waits up to MEDIA_QUEUE_TIMEOUT for a slot and
+    then answers 503 with Retry-After, pushing back on uploaders instead of
+    growing an unbounded backlog. MEDIA_WORKERS=0 runs jobs inline on the
+    event loop, which is only meant for comparison benchmarks.
+
+    A worker that dies (OOM on a decompression bomb, a decoder crash) breaks
+    the whole executor; the jobs it took down fail and the next job starts a
+    fresh pool.
+    """
+    
+    def __init__(self, workers: int, depth: int, timeout: float):
+        self.workers = workers
+        self.depth = depth
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(depth)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._job_ms_total = 0.0
+    
+    async def run(self, fn, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Media workers busy", headers={"Retry-After": "1"})
+        self.in_flight += 1
+        start = time.perf_counter()
+        executor = None
+        try:
+            if not self.workers:
+                result = fn(*args)
+            else:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                executor = self._executor
+                result = await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+            self.completed += 1
+            return result
+        except BrokenProcessPool:
+            self.failed += 1
+            # Every job on the broken pool lands here; only the first replaces it
+            if executor is not None and self._executor is executor:
+                logger.error(f"Media worker died running {fn.__name__}; restarting the pool")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                self.restarts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._job_ms_total += (time.perf_counter() - start) * 1000
+            self.in_flight -= 1
+            self._slots.release()
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    def stats(self) -> Dict[str, Any]:
+        jobs = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "queue_depth": self.depth,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "avg_job_ms": round(self._job_ms_total / jobs, 3) if jobs else 0.0
+        }
+
+media_pipeline = MediaPipeline(MEDIA_WORKERS, MEDIA_QUEUE_DEPTH, MEDIA_QUEUE_TIMEOUT)
+
+# ===== MEDIA STORE =====
+
+# Uploaded bytes are stored once, as <sha256><ext>, with one `media` document
+# per file: {_id: sha256, file_name, thumbnail_name, content_type, size,
+# uploaders, refcount, claimed_at} plus {width, height, placeholder} for
+# images. An upload or hash claim adds the user to `uploaders`, which lets
+# them attach the file; each message sent with it takes a reference, recorded
+# in the message's media_ids, and deleting the message for everyone gives
+# that reference back. Avatars (users.avatar_media_ids) hold theirs until the
+# avatar changes, statuses (status.media_ids) until they expire. media_gc
+# removes files nothing references once no one has uploaded or claimed them
+# for MEDIA_UNREFERENCED_SECONDS.
+
+MEDIA_UNREFERENCED_SECONDS = int(os.environ.get('MEDIA_UNREFERENCED_SECONDS', 24 * 3600))
+MEDIA_GC_SECONDS = int(os.environ.get('MEDIA_GC_SECONDS', 3600))
+MEDIA_PREVIEW_FIELDS = ("width", "height", "placeholder")
+
+def is_sha256(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdefABCDEF" for c in value)
+
+def stored_extension(filename: str, content_type: Optional[str]) -> str:
+    """Extension for stored bytes: the client's, if it is a plain one that
+    names a known type, otherwise the declared content type's. Serving goes
+    by extension, and names like .part are never served."""
+    ext = Path(filename).suffix.lower()
+    if ext[1:].isascii() and ext[1:].isalnum() and len(ext) <= 10 and mimetypes.guess_type(f"file{ext}")[0]:
+        return ext
+    return (content_type and mimetypes.guess_extension(content_type.split(";")[0].strip())) or ""
+
+def media_response(doc: Dict[str, Any], filename: Optional[str], deduplicated: bool) -> Dict[str, Any]:
+    return {
+        "file_id": doc["_id"],
+        "file_url": f"/api/files/{doc['file_name']}",
+        "thumbnail_url": f"/api/files/{doc['thumbnail_name']}" if doc.get("thumbnail_name") else None,
+        "filename": filename,
+        "content_type": doc["content_type"],
+        "size": doc["size"],
+        "sha256": doc["_id"],
+        "width": doc.get("width"),
+        "height": doc.get("height"),
+        "placeholder": doc.get("placeholder"),
+        "deduplicated": deduplicated
+    }
+
+async def claim_media(sha256: str, user_id: str) -> Optional[Dict[str, Any]]:
+    """Let user_id attach stored bytes; None if they are not stored"""
+    return await db.media.find_one_and_update(
+        {"_id": sha256},
+        {"$addToSet": {"uploaders": user_id}, "$set": {"claimed_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def store_upload(path: Path, filename: str, content_type: Optional[str], size: int, sha256: str,
+                       user_id: str) -> Dict[str, Any]:
+    """Keep a completed upload at path, or drop it in favour of identical stored bytes"""
+    existing = await claim_media(sha256, user_id)
+    if existing:
+        path.unlink(missing_ok=True)
+        return media_response(existing, filename, deduplicated=True)
+    
+    file_ext = stored_extension(filename, content_type)
+    file_name = f"{sha256}{file_ext}"
+    file_path = UPLOAD_DIR / file_name
+    path.replace(file_path)
+    
+    # Generate thumbnail, dimensions and BlurHash placeholder for images
+    thumbnail_name = None
+    preview = {}
+    if content_type and content_type.startswith('image/'):
+        thumb_name = f"{sha256}_thumb{file_ext}"
+        try:
+            preview = await media_pipeline.run(media.make_thumbnail, str(file_path), str(UPLOAD_DIR / thumb_name))
+            thumbnail_name = thumb_name
+        except HTTPException:
+            # Workers saturated: refuse the upload so the client backs off and retries
+            file_path.unlink(missing_ok=True)
+            raise
+        except Exception as e:
+            logging.error(f"Thumbnail generation failed: {e}")
+    
+    now = datetime.now(timezone.utc)
+    doc = {
+        "_id": sha256,
+        "file_name": file_name,
+        "thumbnail_name": thumbnail_name,
+        "content_type": content_type,
+        "size": size,
+        "uploaders": [user_id],
+        "refcount": 0,
+        "claimed_at": now,
+        "created_at": now,
+        **preview
+    }
+    try:
+        await db.media.insert_one(doc)
+    except DuplicateKeyError:
+        # The same bytes finished uploading concurrently; share that copy
+        existing = await claim_media(sha256, user_id)
+        if existing:
+            return media_response(existing, filename, deduplicated=True)
+        raise
+    return media_response(doc, filename, deduplicated=False)
+
+def attachment_media_ids(attachments: List[Dict[str, Any]]) -> Set[str]:
+    """Hashes of stored files referenced by message attachments"""
+    ids = set()
+    for attachment in attachments:
+        for key in ("url", "file_url"):
+            url = attachment.get(key)
+            if isinstance(url, str) and url.startswith("/api/files/"):
+                name = url[len("/api/files/"):]
+                if is_sha256(name[:64]) and "_thumb" not in name:
+                    ids.add(name[:64].lower())
+    return ids
+
+async def reference_media(user_id: str, attachments: List[Dict[str, Any]]) -> List[str]:
+    """Take one reference per stored file the attachments point at, for a
+    message user_id is sending. Only files the sender uploaded or claimed
+    can be attached (403 otherwise). Also fills in the image dimensions and
+    placeholder the sender left out, so every reader can lay out and draw
+    the attachment before fetching it. Returns the referenced hashes, to be
+    kept on the message and released with it."""
+    media_ids = sorted(attachment_media_ids(attachments))
+    if not media_ids:
+        return []
+    projection = {field: 1 for field in MEDIA_PREVIEW_FIELDS}
+    docs = await asyncio.gather(*(
+        db.media.find_one_and_update(
+            {"_id": media_id, "uploaders": user_id}, {"$inc": {"refcount": 1}}, projection=projection
+        )
+        for media_id in media_ids
+    ))
+    if not all(docs):
+        await release_media([doc["_id"] for doc in docs if doc])
+        raise HTTPException(status_code=403, detail="Attachments must be uploaded or claimed by the sender")
+    
+    previews = {doc["_id"]: doc for doc in docs}
+    for attachment in attachments:
+        for media_id in attachment_media_ids([attachment]):
+            for field in MEDIA_PREVIEW_FIELDS:
+                if attachment.get(field) is None and previews[media_id].get(field) is not None:
+                    attachment[field] = previews[media_id][field]
+    return media_ids
+
+async def release_media(media_ids: List[str]):
+    """Give back references taken by reference_media; media_gc removes the files"""
+    if media_ids:
+        await db.media.update_many({"_id": {"$in": list(media_ids)}}, {"$inc": {"refcount": -1}})
+
+async def release_expired_status_media():
+    """Give back the references held by statuses that have expired"""
+    expired = {"expires_at": {"$lte": datetime.now(timezone.utc)}, "media_ids": {"$type": "string"}}
+    async for status in db.status.find(expired, {"media_ids": 1}):
+        # Conditional, so two nodes running the GC release each status once
+        cleared = await db.status.update_one({"_id": status["_id"], **expired}, {"$set": {"media_ids": []}})
+        if cleared.modified_count:
+            await release_media(status["media_ids"])
+
+async def media_gc():
+    """Remove stored files nothing references and no one recently uploaded or claimed"""
+    while True:
+        try:
+            await release_expired_status_media()
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=MEDIA_UNREFERENCED_SECONDS)
+            unreferenced = {"refcount": {"$lte": 0}, "claimed_at": {"$lt": cutoff}}
+            removed = 0
+            async for doc in db.media.find(unreferenced, {"file_name": 1, "thumbnail_name": 1}):
+                # Conditional, so a claim or send that just landed keeps the file
+                deleted = await db.media.delete_one({"_id": doc["_id"], **unreferenced})
+                if deleted.deleted_count:
+                    for name in (doc["file_name"], doc.get("thumbnail_name")):
+                        if name:
+                            (UPLOAD_DIR / name).unlink(missing_ok=True)
+                    removed += 1
+            if removed:
+                logger.info(f"Removed {removed} unreferenced media files")
+        except Exception as e:
+            logger.error(f"Media GC failed: {e}")
+        await asyncio.sleep(MEDIA_GC_SECONDS)
+
 # ===== FILE UPLOAD =====
 
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+# Largest accepted file per top-level content type; "*" covers the rest
+UPLOAD_SIZE_LIMITS = {
+    "image": int(os.environ.get('UPLOAD_MAX_IMAGE_BYTES', 16 * 1024 * 1024)),
+    "video": int(os.environ.get('UPLOAD_MAX_VIDEO_BYTES', 256 * 1024 * 1024)),
+    "audio": int(os.environ.get('UPLOAD_MAX_AUDIO_BYTES', 64 * 1024 * 1024)),
+    "*": int(os.environ.get('UPLOAD_MAX_BYTES', 100 * 1024 * 1024)),
+}
+# Room for multipart boundaries and part headers around the file
+UPLOAD_FRAMING_BYTES = 64 * 1024
+
+def upload_size_limit(content_type: Optional[str]) -> int:
+    major = (content_type or "").split("/", 1)[0]
+    return UPLOAD_SIZE_LIMITS.get(major, UPLOAD_SIZE_LIMITS["*"])
+
+class StreamedUpload:
+    """The file part of a multipart upload, written to disk as it arrives.
+
+    Data is hashed and counted as it comes in and written out in
+    UPLOAD_CHUNK_SIZE blocks, so memory per upload stays around one chunk.
+    Going over the size limit for the part's content type aborts with 413
+    right away instead of after the whole body has been received.
+    """
+    
+    def __init__(self, path: Path, filename: str, content_type: Optional[str]):
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.limit = upload_size_limit(content_type)
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._file = None
+    
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+    
+    async def open(self):
+        self._file = await aiofiles.open(self.path, 'wb')
+    
+    async def feed(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise HTTPException(status_code=413, detail=f"File exceeds {self.limit} bytes")
+        self._sha256.update(data)
+        self._buffer += data
+        while len(self._buffer) >= UPLOAD_CHUNK_SIZE:
+            await self._file.write(bytes(self._buffer[:UPLOAD_CHUNK_SIZE]))
+            del self._buffer[:UPLOAD_CHUNK_SIZE]
+    
+    async def finish(self):
+        if self._buffer:
+            await self._file.write(bytes(self._buffer))
+            self._buffer.clear()
+        await self._file.close()
+    
+    async def discard(self):
+        if self._file is not None:
+            await self._file.close()
+        self.path.unlink(missing_ok=True)
+
+async def receive_upload(request: Request, path: Path, field: str = "file") -> StreamedUpload:
+    """Stream the `field` file part of a multipart request body to path"""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > max(UPLOAD_SIZE_LIMITS.values()) + UPLOAD_FRAMING_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+    
+    # The parser's callbacks are synchronous: they only queue events, and
+    # the async file work happens after each network chunk is parsed
+    events: List[Tuple[str, Any]] = []
+    headers: Dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+    
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+    
+    def on_headers_finished():
+        events.append(("part", dict(headers)))
+        headers.clear()
+    
+    parser = MultipartParser(boundary, {
+        "on_header_field": lambda data, start, end: header_field.extend(data[start:end]),
+        "on_header_value": lambda data, start, end: header_value.extend(data[start:end]),
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": lambda data, start, end: events.append(("data", bytes(data[start:end]))),
+        "on_part_end": lambda: events.append(("end", None)),
+    })
+    
+    upload: Optional[StreamedUpload] = None
+    receiving = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, value in events:
+                if kind == "part":
+                    _, disposition = parse_options_header(value.get(b"content-disposition", b""))
+                    receiving = (
+                        upload is None
+                        and disposition.get(b"name") == field.encode()
+                        and b"filename" in disposition
+                    )
+                    if receiving:
+                        part_type = value.get(b"content-type")
+                        upload = StreamedUpload(
+                            path,
+                            disposition[b"filename"].decode("utf-8", "replace"),
+                            part_type.decode("latin-1") if part_type else None
+                        )
+                        await upload.open()
+                elif kind == "data" and receiving:
+                    await upload.feed(value)
+                elif kind == "end" and receiving:
+                    await upload.finish()
+                    receiving = False
+            events.clear()
+        parser.finalize()
+        if upload is None or receiving:
+            raise HTTPException(status_code=400, detail=f"No complete '{field}' file in upload")
+    except BaseException:
+        if upload is not None:
+            await upload.discard()
+        raise
+    return upload
+
 @api_router.post("/upload")
-async def upload_file(user_id: str, file: UploadFile = File(...)):
-    file_id = str(uuid.uuid4())
-    file_ext = Path(file.filename).suffix
-    file_path = UPLOAD_DIR / f"{file_id}{file_ext}"
-    
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        await f.write(content)
-    
-    # Generate thumbnail for images
-    thumbnail_url = None
-    if file.content_type and file.content_type.startswith('image/'):
+async def upload_file(user_id: str, request: Request):
+    """Multipart upload with a `file` part, streamed to disk and stored by content hash"""
+    upload = await receive_upload(request, UPLOAD_DIR / f"{uuid.uuid4()}.part")
+    return await store_upload(upload.path, upload.filename, upload.content_type, upload.size, upload.sha256, user_id)
+
+@api_router.post("/upload/{sha256}")
+async def upload_by_hash(user_id: str, sha256: str, filename: Optional[str] = None):
+    """Reuse already stored bytes: hash the file client-side and call this
+    first. Same response as POST /api/upload; 404 means upload the file."""
+    if not is_sha256(sha256):
+        raise HTTPException(status_code=400, detail="Expected a hex SHA-256 digest")
+    doc = await claim_media(sha256.lower(), user_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Not stored")
+    return media_response(doc, filename, deduplicated=True)
+
+# ===== FILE SERVING =====
+
+FILE_READ_CHUNK_SIZE = 256 * 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+class FileRangeResponse(Response):
+    """One byte range of a file, as a 206 (or 200 for the whole file).
+
+    Hands the file descriptor to the server through the ASGI zerocopysend
+    extension (sendfile) when it is offered, and streams
+    FILE_READ_CHUNK_SIZE reads otherwise.
+    """
+    
+    def __init__(self, path: Path, start: int, end: int, status_code: int,
+                 headers: Dict[str, str], media_type: Optional[str]):
+        self.path = path
+        self.start = start
+        self.length = end - start + 1
+        super().__init__(status_code=status_code, headers={**headers, "content-length": str(self.length)},
+                         media_type=media_type)
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, 'rb') as f:
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start,
+                            "count": self.length, "more_body": False})
+            return
+        async with aiofiles.open(self.path, 'rb') as f:
+            await f.seek(self.start)
+            remaining = self.length
+            while remaining:
+                chunk = await f.read(min(FILE_READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining:
+                await send({"type": "http.response.body", "body": b""})
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(start, end) for a single `bytes=` range; None to serve the whole file.
+    Raises 416 for a range that lies entirely past the end."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None  # multipart/byteranges is not supported; full 200 is allowed
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(0, size - suffix), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else max(start, size - 1)
+            if end < start:
+                raise ValueError
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires"""
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+async def _hash_file_etag(key: Tuple[str, int, int]) -> str:
+    return await asyncio.to_thread(hash_file, UPLOAD_DIR / key[0])
+
+# Files stored before content addressing get their hash computed once per
+# (name, mtime, size)
+legacy_etags = AsyncTTLCache(_hash_file_etag, max_size=10000, ttl=24 * 3600)
+
+# ===== IMAGE VARIANTS =====
+
+VARIANT_DIR = UPLOAD_DIR / 'variants'
+VARIANT_DIR.mkdir(exist_ok=True)
+# Requested widths snap up to one of these so the cache stays small
+VARIANT_WIDTHS = (160, 320, 480, 720, 1080, 1600)
+VARIANT_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg", "png": ".png"}
+VARIANT_CACHE_MAX_BYTES = int(os.environ.get('VARIANT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+class VariantCache:
+    """Resized/re-encoded images rendered on first request, kept on disk.
+
+    Each variant is rendered once in the media pool (concurrent requests
+    for it wait on the same render) and then served like any stored file.
+    Once the variants exceed max_bytes the least recently served are
+    deleted. Accounting is per process, seeded by scan() at startup; a
+    variant evicted by another worker is simply rendered again.
+    """
+    
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files: OrderedDict = OrderedDict()  # name -> size, least recently used first
+        self._rendering: Dict[str, asyncio.Future] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.renders = 0
+        self.evictions = 0
+    
+    def scan(self):
+        entries = sorted(
+            (e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith(".tmp")),
+            key=lambda e: e.stat().st_mtime
+        )
+        for entry in entries:
+            self._add(entry.name, entry.stat().st_size)
+    
+    def _add(self, name: str, size: int):
+        self.bytes += size - self._files.pop(name, 0)
+        self._files[name] = size
+        while self.bytes > self.max_bytes and len(self._files) > 1:
+            old, old_size = self._files.popitem(last=False)
+            (self.directory / old).unlink(missing_ok=True)
+            self.bytes -= old_size
+            self.evictions += 1
+    
+    async def get(self, source: Path, name: str, width: int, fmt: str) -> Path:
+        path = self.directory / name
+        if path.is_file():
+            self.hits += 1
+            if name in self._files:
+                self._files.move_to_end(name)
+            else:
+                self._add(name, path.stat().st_size)
+            return path
+        if name in self._rendering:
+            return await asyncio.shield(self._rendering[name])
+        
+        future = asyncio.get_running_loop().create_future()
+        self._rendering[name] = future
+        tmp = self.directory / f"{name}.{uuid.uuid4().hex}.tmp"
         try:
-            img = Image.open(io.BytesIO(content))
-            img.thumbnail((200, 200))
-            thumb_path = UPLOAD_DIR / f"{file_id}_thumb{file_ext}"
-            img.save(thumb_path)
-            thumbnail_url = f"/api/files/{file_id}_thumb{file_ext}"
+            await media_pipeline.run(media.make_variant, str(source), str(tmp), width, fmt)
+            tmp.replace(path)
+            self.renders += 1
+            self._add(name, path.stat().st_size)
+            future.set_result(path)
+            return path
         except Exception as e:
-            logging.error(f"Thumbnail generation failed: {e}")
+            tmp.unlink(missing_ok=True)
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._rendering[name]
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "files": len(self._files),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "renders": self.renders,
+            "evictions": self.evictions
+        }
+
+variant_cache = VariantCache(VARIANT_DIR, VARIANT_CACHE_MAX_BYTES)
+
+def variant_spec(file_path: Path, w: Optional[int], fmt: Optional[str]) -> Tuple[str, int, str]:
+    """(file name, width, fmt) of the variant of a content-addressed image for ?w=&fmt="""
+    if fmt is None:
+        fmt = {".webp": "webp", ".png": "png"}.get(file_path.suffix.lower(), "jpeg")
+    if fmt not in VARIANT_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"fmt must be one of {', '.join(VARIANT_EXTENSIONS)}")
+    width = next((allowed for allowed in VARIANT_WIDTHS if allowed >= (w or VARIANT_WIDTHS[-1])), VARIANT_WIDTHS[-1])
+    return f"{file_path.stem}_w{width}_{fmt}{VARIANT_EXTENSIONS[fmt]}", width, fmt
+
+async def image_variant(file_path: Path, name: str, width: int, fmt: str) -> Path:
+    """The cached variant described by variant_spec(), rendered on first use"""
+    try:
+        return await variant_cache.get(file_path, name, width, fmt)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Rendering {name} failed: {e}")
+        raise HTTPException(status_code=415, detail="Cannot render this image")
+
+@api_router.api_route("/files/{file_name}", methods=["GET", "HEAD"])
+async def get_file(file_name: str, request: Request, w: Optional[int] = Query(None, gt=0),
+                   fmt: Optional[str] = None):
+    """Range requests, strong ETags and conditional GET.
+
+    <sha256>* names never change content, so they get an immutable
+    Cache-Control; older uuid names must revalidate with If-None-Match.
+    A bare <sha256> resolves through the media store. For stored images,
+    ?w= and/or ?fmt=webp|jpeg|png serve a resized variant instead.
+    """
+    if is_sha256(file_name):
+        doc = await db.media.find_one({"_id": file_name.lower()}, {"file_name": 1})
+        if not doc:
+            raise HTTPException(status_code=404, detail="File not found")
+        file_name = doc["file_name"]
+    file_path = UPLOAD_DIR / file_name
+    if file_name.endswith(".part") or not file_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
     
-    file_url = f"/api/files/{file_id}{file_ext}"
+    is_image = (mimetypes.guess_type(file_name)[0] or "").startswith("image/")
+    if (w or fmt) and is_image and is_sha256(file_name[:64]):
+        name, width, fmt = variant_spec(file_path, w, fmt)
+        # The ETag follows from the name, so revalidating an evicted variant
+        # is answered without rendering it again
+        etag = f'"{name.rsplit(".", 1)[0]}"'
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={
+                "etag": etag, "cache-control": IMMUTABLE_CACHE_CONTROL, "accept-ranges": "bytes"
+            })
+        file_path = await image_variant(file_path, name, width, fmt)
+        file_name = file_path.name
+    
+    stat = file_path.stat()
+    stem = file_name.rsplit(".", 1)[0]
+    if is_sha256(stem[:64]):
+        etag, cache_control = f'"{stem}"', IMMUTABLE_CACHE_CONTROL
+    else:
+        etag = f'"{await legacy_etags.get((file_name, stat.st_mtime_ns, stat.st_size))}"'
+        cache_control = REVALIDATE_CACHE_CONTROL
+    headers = {"etag": etag, "cache-control": cache_control, "accept-ranges": "bytes"}
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    media_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range(range_header, stat.st_size)
+    if byte_range is None:
+        # Whole file: FileResponse can use the pathsend extension where offered
+        return FileResponse(file_path, headers=headers, media_type=media_type, stat_result=stat)
     
+    start, end = byte_range
+    headers["content-range"] = f"bytes {start}-{end}/{stat.st_size}"
+    return FileRangeResponse(file_path, start, end, 206, headers, media_type)
+
+# ===== RESUMABLE UPLOADS =====
+
+# Large files go up in pieces: POST /uploads opens a session and a sparse
+# <upload_id>.part file of the declared size, PUT /uploads/{id}?offset=N
+# writes one chunk in place (any order, in parallel), GET reports which
+# byte ranges have landed, and POST /uploads/{id}/complete hashes the file
+# and stores it like a single-shot upload. Abandoned sessions expire.
+UPLOAD_SESSION_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_CHUNK_SIZE', 4 * 1024 * 1024))
+UPLOAD_SESSION_TTL_SECONDS = int(os.environ.get('UPLOAD_SESSION_TTL_SECONDS', 24 * 3600))
+UPLOAD_SESSION_GC_SECONDS = int(os.environ.get('UPLOAD_SESSION_GC_SECONDS', 600))
+# How long complete waits for chunk PUTs still being written
+UPLOAD_FINALIZE_WAIT_SECONDS = float(os.environ.get('UPLOAD_FINALIZE_WAIT_SECONDS', 10))
+# A chunk PUT holds a lease on its session, renewed as data arrives; complete
+# treats writers whose lease ran out (a worker that died mid-PUT) as gone
+UPLOAD_WRITER_LEASE_SECONDS = float(os.environ.get('UPLOAD_WRITER_LEASE_SECONDS', 60))
+
+def upload_session_path(upload_id: str) -> Path:
+    return UPLOAD_DIR / f"{upload_id}.part"
+
+def upload_finalize_path(upload_id: str) -> Path:
+    return UPLOAD_DIR / f"{upload_id}.finalize.part"
+
+def merge_ranges(ranges: List[List[int]]) -> List[List[int]]:
+    merged: List[List[int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def upload_session_response(session: Dict[str, Any]) -> Dict[str, Any]:
+    received = merge_ranges(session["received"])
     return {
-        "file_id": file_id,
-        "file_url": file_url,
-        "thumbnail_url": thumbnail_url,
-        "filename": file.filename,
-        "content_type": file.content_type,
-        "size": len(content)
+        "upload_id": session["id"],
+        "size": session["size"],
+        "chunk_size": UPLOAD_SESSION_CHUNK_SIZE,
+        "received": received,
+        "received_bytes": sum(end - start for start, end in received),
+        "expires_at": session["expires_at"]
     }
 
-@api_router.get("/files/{file_name}")
-async def get_file(file_name: str):
-    file_path = UPLOAD_DIR / file_name
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path)
+async def get_upload_session(upload_id: str, user_id: str) -> Dict[str, Any]:
+    session = await db.upload_sessions.find_one({"id": upload_id}, {"_id": 0})
+    if not session or as_utc(session["expires_at"]) <= datetime.now(timezone.utc):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if session["user_id"] != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return session
+
+def hash_file(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(UPLOAD_CHUNK_SIZE):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+@api_router.post("/uploads")
+async def create_upload_session(user_id: str, data: UploadSessionCreate):
+    limit = upload_size_limit(data.content_type)
+    if data.size > limit:
+        raise HTTPException(status_code=413, detail=f"File exceeds {limit} bytes")
+    if data.sha256 and not is_sha256(data.sha256):
+        raise HTTPException(status_code=400, detail="Expected a hex SHA-256 digest")
+    
+    now = datetime.now(timezone.utc)
+    session = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "filename": data.filename,
+        "content_type": data.content_type,
+        "size": data.size,
+        "sha256": data.sha256.lower() if data.sha256 else None,
+        "received": [],
+        "state": "open",
+        "writers": [],  # leases of chunk PUTs in flight: {id, until}
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)
+    }
+    # Sparse until chunks land; every PUT writes into its own byte range
+    with open(upload_session_path(session["id"]), 'wb') as f:
+        f.truncate(data.size)
+    await db.upload_sessions.insert_one(dict(session))
+    return upload_session_response(session)
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload_status(upload_id: str, user_id: str):
+    return upload_session_response(await get_upload_session(upload_id, user_id))
+
+@api_router.put("/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, user_id: str, offset: int, request: Request):
+    """Raw chunk body, written straight into place at offset"""
+    session = await get_upload_session(upload_id, user_id)
+    if offset < 0 or offset > session["size"]:
+        raise HTTPException(status_code=400, detail="Offset outside the file")
+    # Register as a writer; complete waits until no chunk is mid-write
+    writer_id = str(uuid.uuid4())
+    lease = lambda: datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_WRITER_LEASE_SECONDS)
+    session = await db.upload_sessions.find_one_and_update(
+        {"id": upload_id, "state": "open"},
+        {"$push": {"writers": {"id": writer_id, "until": lease()}}},
+        projection={"_id": 0}
+    )
+    if not session:
+        raise HTTPException(status_code=409, detail="Upload is being finalized")
+    
+    position = offset
+    renewed = time.monotonic()
+    update: Dict[str, Any] = {"$pull": {"writers": {"id": writer_id}}}
+    try:
+        async with aiofiles.open(upload_session_path(upload_id), 'r+b') as f:
+            await f.seek(offset)
+            async for chunk in request.stream():
+                if position + len(chunk) > session["size"]:
+                    raise HTTPException(status_code=413, detail="Chunk runs past the declared size")
+                if time.monotonic() - renewed > UPLOAD_WRITER_LEASE_SECONDS / 2:
+                    # A stalled PUT may have been given up on; never write
+                    # into a file that complete is already storing
+                    renewal = await db.upload_sessions.update_one(
+                        {"id": upload_id, "state": "open", "writers.id": writer_id},
+                        {"$set": {"writers.$.until": lease()}}
+                    )
+                    if not renewal.matched_count:
+                        raise HTTPException(status_code=409, detail="Upload is being finalized")
+                    renewed = time.monotonic()
+                await f.write(chunk)
+                position += len(chunk)
+        if position > offset:
+            update["$push"] = {"received": [offset, position]}
+            update["$set"] = {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=UPLOAD_SESSION_TTL_SECONDS)}
+    finally:
+        session = await db.upload_sessions.find_one_and_update(
+            {"id": upload_id}, update, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return upload_session_response(session)
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload_session(upload_id: str, user_id: str):
+    """Check every byte arrived, then store and thumbnail like POST /upload"""
+    await get_upload_session(upload_id, user_id)
+    
+    # One finalizer per session, once in-flight chunk PUTs have finished or
+    # their lease has run out; further PUTs are refused from here on
+    deadline = time.monotonic() + UPLOAD_FINALIZE_WAIT_SECONDS
+    while True:
+        live_writer = {"$elemMatch": {"until": {"$gt": datetime.now(timezone.utc)}}}
+        session = await db.upload_sessions.find_one_and_update(
+            {"id": upload_id, "state": "open", "writers": {"$not": live_writer}},
+            {"$set": {"state": "finalizing"}},
+            projection={"_id": 0}
+        )
+        if session or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.1)
+    if not session:
+        raise HTTPException(status_code=409, detail="Upload is being written or finalized")
+    
+    path = upload_session_path(upload_id)
+    # store_upload consumes the file it is given (renamed into place, or
+    # removed on failure); hand it a hard link so the session's data
+    # survives a failed finalize and complete can simply be retried
+    link = upload_finalize_path(upload_id)
+    try:
+        if session["size"] and merge_ranges(session["received"]) != [[0, session["size"]]]:
+            raise HTTPException(status_code=409, detail="Upload incomplete")
+        sha256 = await asyncio.to_thread(hash_file, path)
+        if session["sha256"] and session["sha256"] != sha256:
+            raise HTTPException(status_code=422, detail="Content does not match the declared sha256")
+        link.unlink(missing_ok=True)
+        os.link(path, link)
+        result = await store_upload(link, session["filename"], session["content_type"], session["size"], sha256,
+                                    user_id)
+    except BaseException:
+        link.unlink(missing_ok=True)
+        await db.upload_sessions.update_one({"id": upload_id}, {"$set": {"state": "open"}})
+        raise
+    await db.upload_sessions.delete_one({"id": upload_id})
+    path.unlink(missing_ok=True)
+    return result
+
+async def upload_session_gc():
+    """Drop expired upload sessions and their partial files"""
+    while True:
+        try:
+            now = datetime.now(timezone.utc)
+            expired = await db.upload_sessions.find({"expires_at": {"$lte": now}}, {"_id": 0, "id": 1}).to_list(None)
+            for session in expired:
+                upload_session_path(session["id"]).unlink(missing_ok=True)
+                upload_finalize_path(session["id"]).unlink(missing_ok=True)
+            if expired:
+                await db.upload_sessions.delete_many({"id": {"$in": [s["id"] for s in expired]}})
+                logger.info(f"Expired {len(expired)} upload sessions")
+        except Exception as e:
+            logger.error(f"Upload session GC failed: {e}")
+        await asyncio.sleep(UPLOAD_SESSION_GC_SECONDS)
 
 # ===== STATUS ENDPOINTS =====
 
 @api_router.post("/status")
 async def create_status(user_id: str, content_type: str, content: str, media_url: Optional[str] = None):
+    # Held until the status expires; media_gc gives the reference back
+    media_ids = await reference_media(user_id, [{"url": media_url}]) if media_url else []
     status = Status(
         user_id=user_id,
         content_type=content_type,
         content=content,
-        media_url=media_url
+        media_url=media_url,
+        media_ids=media_ids
     )
     
-    status_dict = status.model_dump()
-    status_dict['created_at'] = status_dict['created_at'].isoformat()
-    status_dict['expires_at'] = status_dict['expires_at'].isoformat()
-    await db.status.insert_one(status_dict)
+    try:
+        await db.status.insert_one(status.model_dump())
+    except Exception:
+        await release_media(media_ids)
+        raise
+    
+    # Everyone who has the poster as a contact sees the status in get_statuses
+    followers = await db.contacts.find({"contact_user_id": user_id}, {"_id": 0, "user_id": 1}).to_list(None)
+    await record_change("status_created", [user_id] + [f["user_id"] for f in followers], status.model_dump())
     
     return status
 
@@ -644,7 +2811,7 @@ async def get_statuses(user_id: str):
     contact_ids = [c["contact_user_id"] for c in contacts]
     
     # Get active statuses
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     statuses = await db.status.find({
         "user_id": {"$in": contact_ids},
         "expires_at": {"$gt": now}
@@ -656,8 +2823,7 @@ async def get_statuses(user_id: str):
 
 @api_router.post("/calls")
 async def initiate_call(user_id: str, chat_id: str, call_type: str):
-    chat = await db.chats.find_one({"id": chat_id}, {"_id": 0})
-    if not chat or user_id not in chat["participants"]:
+    if not await is_chat_member(chat_id, user_id):
         raise HTTPException(status_code=403, detail="Not authorized")
     
     call = Call(
@@ -668,15 +2834,71 @@ async def initiate_call(user_id: str, chat_id: str, call_type: str):
         status="ringing"
     )
     
-    call_dict = call.model_dump()
-    call_dict['started_at'] = call_dict['started_at'].isoformat()
-    await db.calls.insert_one(call_dict)
+    await db.calls.insert_one(call.model_dump())
     
     # Emit call signal
     await sio.emit('incoming_call', call.model_dump(), room=chat_id)
     
     return call
 
+# ===== SYNC ENDPOINTS =====
+
+@api_router.get("/sync")
+async def sync(user_id: str, since: Optional[str] = None, limit: int = 500):
+    """Changes for user_id since a token, oldest first.
+
+    Entries carry an id; a change can be delivered twice around the settle
+    window, so clients should skip ids they have already applied. reset=True
+    means the token is missing or older than the log's retention and the
+    client must reload chats and messages, then continue from next_token.
+    """
+    limit = max(1, min(limit, 1000))
+    now = datetime.now(timezone.utc)
+    settled = ObjectId.from_datetime(now - timedelta(seconds=CHANGE_LOG_SETTLE_SECONDS))
+    
+    since_id = None
+    if since:
+        try:
+            since_id = ObjectId(decode_cursor(since, 1)[0])
+        except (InvalidId, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+    if since_id is None or since_id.generation_time < now - timedelta(seconds=CHANGE_LOG_RETENTION_SECONDS):
+        return {"changes": [], "next_token": encode_cursor(str(settled)), "has_more": False, "reset": True}
+    
+    entries = await db.changes.find(
+        {"user_id": user_id, "_id": {"$gt": since_id}}
+    ).sort("_id", 1).limit(limit + 1).to_list(limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    
+    next_id = since_id
+    if entries:
+        next_id = entries[-1]["_id"] if has_more else max(since_id, min(entries[-1]["_id"], settled))
+    
+    changes = [{
+        "id": str(entry["_id"]),
+        "kind": entry["kind"],
+        "chat_id": entry["chat_id"],
+        "payload": entry["payload"],
+        "created_at": entry["created_at"]
+    } for entry in entries]
+    return {"changes": changes, "next_token": encode_cursor(str(next_id)), "has_more": has_more, "reset": False}
+
+# ===== METRICS =====
+
+@api_router.get("/metrics")
+async def get_metrics():
+    return {
+        "user_cache": user_cache.stats(),
+        "chat_members": chat_members.stats(),
+        "connections": connections.stats(),
+        "presence": presence_broadcaster.stats(),
+        "typing": typing_tracker.stats(),
+        "activity": activity_buffer.stats(),
+        "media": media_pipeline.stats(),
+        "variants": variant_cache.stats()
+    }
+
 # Include router
 app.include_router(api_router)
 
@@ -689,6 +2911,323 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ===== CONNECTIONS =====
+
+def user_room(user_id: str) -> str:
+    """Room joined by every socket of a user, for per-user delivery"""
+    return f"user:{user_id}"
+
+class ConnectionRegistry:
+    """Authenticated sockets of this process, indexed both ways.
+
+    A user can hold any number of sockets (tabs, phones, desktop); each sid
+    maps back to its (user_id, device_id) so disconnect is O(1).
+    """
+    
+    def __init__(self):
+        self._by_user: Dict[str, Set[str]] = {}
+        self._by_sid: Dict[str, Tuple[str, Optional[str]]] = {}
+    
+    def add(self, sid: str, user_id: str, device_id: Optional[str] = None) -> bool:
+        """Register sid; True when it is the user's first live socket"""
+        self.remove(sid)
+        sids = self._by_user.setdefault(user_id, set())
+        sids.add(sid)
+        self._by_sid[sid] = (user_id, device_id)
+        return len(sids) == 1
+    
+    def remove(self, sid: str) -> Optional[Tuple[str, bool]]:
+        """Forget sid; returns (user_id, went_offline) if it was registered"""
+        owner = self._by_sid.pop(sid, None)
+        if owner is None:
+            return None
+        user_id = owner[0]
+        sids = self._by_user[user_id]
+        sids.discard(sid)
+        if not sids:
+            del self._by_user[user_id]
+        return user_id, not sids
+    
+    def user_of(self, sid: str) -> Optional[str]:
+        owner = self._by_sid.get(sid)
+        return owner[0] if owner else None
+    
+    def device_of(self, sid: str) -> Optional[str]:
+        owner = self._by_sid.get(sid)
+        return owner[1] if owner else None
+    
+    def sids(self, user_id: str) -> Set[str]:
+        return set(self._by_user.get(user_id, ()))
+    
+    def user_devices(self, user_id: str) -> Dict[str, Optional[str]]:
+        """sid -> device_id for each live socket of the user"""
+        return {sid: self._by_sid[sid][1] for sid in self._by_user.get(user_id, ())}
+    
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self._by_user
+    
+    def stats(self) -> Dict[str, int]:
+        return {"users": len(self._by_user), "sockets": len(self._by_sid)}
+
+connections = ConnectionRegistry()
+
+# Cluster-wide presence. ConnectionRegistry only sees this process's sockets,
+# so whether a user just came online (or went offline) everywhere is decided
+# on one presence document per user, updated atomically. Each process
+# heartbeats under NODE_ID; sockets of a node that stops heartbeating are
+# swept by the survivors.
+NODE_ID = uuid.uuid4().hex
+PRESENCE_HEARTBEAT_SECONDS = int(os.environ.get('PRESENCE_HEARTBEAT_SECONDS', 30))
+
+async def presence_connect(user_id: str, sid: str, device_id: Optional[str]) -> bool:
+    """Record a socket; True when it is the user's first anywhere in the cluster"""
+    doc = await db.presence.find_one_and_update(
+        {"_id": user_id},
+        {"$push": {"sockets": {"sid": sid, "node": NODE_ID, "device_id": device_id}}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return len(doc["sockets"]) == 1
+
+async def presence_disconnect(user_id: str, sid: str) -> bool:
+    """Drop a socket; True when the user has none left anywhere"""
+    doc = await db.presence.find_one_and_update(
+        {"_id": user_id},
+        {"$pull": {"sockets": {"sid": sid}}},
+        return_document=ReturnDocument.AFTER
+    )
+    return doc is not None and not doc["sockets"]
+
+async def presence_heartbeat():
+    while True:
+        try:
+            now = datetime.now(timezone.utc)
+            await db.presence_nodes.update_one({"_id": NODE_ID}, {"$set": {"seen_at": now}}, upsert=True)
+            cutoff = now - timedelta(seconds=3 * PRESENCE_HEARTBEAT_SECONDS)
+            dead = [n["_id"] for n in await db.presence_nodes.find({"seen_at": {"$lt": cutoff}}).to_list(None)]
+            if dead:
+                swept = await db.presence.find({"sockets.node": {"$in": dead}}, {"_id": 1}).to_list(None)
+                await db.presence.update_many(
+                    {"sockets.node": {"$in": dead}},
+                    {"$pull": {"sockets": {"node": {"$in": dead}}}}
+                )
+                await db.presence_nodes.delete_many({"_id": {"$in": dead}})
+                for doc in swept:
+                    presence_broadcaster.offline(doc["_id"])
+                logger.info(f"Swept presence of dead nodes: {', '.join(dead)}")
+        except Exception as e:
+            logger.error(f"Presence heartbeat failed: {e}")
+        await asyncio.sleep(PRESENCE_HEARTBEAT_SECONDS)
+
+async def presence_shutdown():
+    await db.presence.update_many({"sockets.node": NODE_ID}, {"$pull": {"sockets": {"node": NODE_ID}}})
+    await db.presence_nodes.delete_one({"_id": NODE_ID})
+
+# ===== PRESENCE =====
+
+PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', 2))
+PRESENCE_DEBOUNCE_SECONDS = float(os.environ.get('PRESENCE_DEBOUNCE_SECONDS', 10))
+
+async def presence_audiences(user_ids: List[str]) -> Dict[str, Set[str]]:
+    """Who may see each user's presence: people who saved them as a contact
+    and people they share a chat with, minus anyone they blocked"""
+    audiences: Dict[str, Set[str]] = {user_id: set() for user_id in user_ids}
+    contacts = db.contacts.find(
+        {"contact_user_id": {"$in": user_ids}, "is_blocked": {"$ne": True}},
+        {"_id": 0, "user_id": 1, "contact_user_id": 1}
+    )
+    async for contact in contacts:
+        audiences[contact["contact_user_id"]].add(contact["user_id"])
+    async for chat in db.chats.find({"participants": {"$in": user_ids}}, {"_id": 0, "participants": 1}):
+        for user_id in chat["participants"]:
+            if user_id in audiences:
+                audiences[user_id].update(chat["participants"])
+    blocked = db.contacts.find(
+        {"user_id": {"$in": user_ids}, "is_blocked": True},
+        {"_id": 0, "user_id": 1, "contact_user_id": 1}
+    )
+    async for contact in blocked:
+        audiences[contact["user_id"]].discard(contact["contact_user_id"])
+    for user_id, audience in audiences.items():
+        audience.discard(user_id)
+    return audiences
+
+class PresenceBroadcaster:
+    """Coalesces online/offline transitions into batched `presence` frames.
+
+    Transitions queue up and every PRESENCE_FLUSH_SECONDS each online member
+    of the audience gets one frame, {"updates": [{user_id, online}, ...]},
+    on their user room. Offline is held back for PRESENCE_DEBOUNCE_SECONDS
+    so a reload or network blip cancels it instead of flapping. Users with
+    privacy_settings.online_status off are never announced.
+    """
+
+    def __init__(self, flush_interval: float, debounce: float):
+        self.flush_interval = flush_interval
+        self.debounce = debounce
+        self._pending: Dict[str, Tuple[bool, float]] = {}  # user_id -> (online, queued at)
+        self.frames = 0
+        self.updates = 0
+        self.suppressed = 0
+
+    def _queue(self, user_id: str, online: bool):
+        pending = self._pending.pop(user_id, None)
+        if pending is not None and pending[0] != online:
+            # Back to the state everyone last saw; nothing to announce
+            self.suppressed += 1
+            return
+        self._pending[user_id] = (online, time.monotonic())
+
+    def online(self, user_id: str):
+        self._queue(user_id, True)
+
+    def offline(self, user_id: str):
+        self._queue(user_id, False)
+
+    async def flush(self):
+        now = time.monotonic()
+        due = {
+            user_id: online for user_id, (online, queued_at) in self._pending.items()
+            if online or now - queued_at >= self.debounce
+        }
+        if not due:
+            return
+        for user_id in due:
+            del self._pending[user_id]
+
+        # The user may have reconnected through another worker meanwhile
+        offline = [user_id for user_id, online in due.items() if not online]
+        if offline:
+            back = db.presence.find({"_id": {"$in": offline}, "sockets.0": {"$exists": True}}, {"_id": 1})
+            async for doc in back:
+                del due[doc["_id"]]
+                self.suppressed += 1
+
+        users = await user_cache.get_many(list(due))
+        visible = [
+            user_id for user_id in due
+            if user_id in users and users[user_id].privacy_settings.get("online_status", True)
+        ]
+        if not visible:
+            return
+
+        frames: Dict[str, List[Dict[str, Any]]] = {}
+        for user_id, audience in (await presence_audiences(visible)).items():
+            update = {"user_id": user_id, "online": due[user_id]}
+            for recipient in audience:
+                frames.setdefault(recipient, []).append(update)
+        if not frames:
+            return
+
+        # Only sockets can receive frames; skip audience members who are offline
+        online_recipients = db.presence.find(
+            {"_id": {"$in": list(frames)}, "sockets.0": {"$exists": True}}, {"_id": 1}
+        )
+        async for doc in online_recipients:
+            updates = frames[doc["_id"]]
+            await sio.emit('presence', {"updates": updates}, room=user_room(doc["_id"]))
+            self.frames += 1
+            self.updates += len(updates)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "frames": self.frames,
+            "updates": self.updates,
+            "suppressed": self.suppressed
+        }
+
+presence_broadcaster = PresenceBroadcaster(PRESENCE_FLUSH_SECONDS, PRESENCE_DEBOUNCE_SECONDS)
+
+# ===== TYPING =====
+
+TYPING_FLUSH_SECONDS = float(os.environ.get('TYPING_FLUSH_SECONDS', 0.5))
+TYPING_TIMEOUT_SECONDS = float(os.environ.get('TYPING_TIMEOUT_SECONDS', 6))
+
+class TypingTracker:
+    """Per-(chat, user) typing state, announced as one frame per chat.
+
+    typing_start/typing_stop only move a user in or out of the chat's typing
+    set; a start not refreshed within TYPING_TIMEOUT_SECONDS lapses on its
+    own. Every TYPING_FLUSH_SECONDS each chat whose set changed gets a single
+    `typing` frame, {chat_id, typing: [...], stopped: [...]}, so room traffic
+    is bounded by the interval no matter how often clients send events.
+    """
+
+    def __init__(self, flush_interval: float, timeout: float):
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._typing: Dict[str, Dict[str, float]] = {}  # chat_id -> user_id -> expires at
+        self._announced: Dict[str, Set[str]] = {}
+        self._dirty: Set[str] = set()
+        self.events = 0
+        self.frames = 0
+
+    def start(self, chat_id: str, user_id: str):
+        self.events += 1
+        users = self._typing.setdefault(chat_id, {})
+        if user_id not in users:
+            self._dirty.add(chat_id)
+        users[user_id] = time.monotonic() + self.timeout
+
+    def stop(self, chat_id: str, user_id: str):
+        self.events += 1
+        self._remove(chat_id, user_id)
+
+    def drop_user(self, user_id: str):
+        """Stop the user everywhere, e.g. when their last socket goes"""
+        for chat_id in [c for c, users in self._typing.items() if user_id in users]:
+            self._remove(chat_id, user_id)
+
+    def _remove(self, chat_id: str, user_id: str):
+        users = self._typing.get(chat_id)
+        if users and users.pop(user_id, None) is not None:
+            self._dirty.add(chat_id)
+            if not users:
+                del self._typing[chat_id]
+
+    async def flush(self):
+        now = time.monotonic()
+        for chat_id, users in list(self._typing.items()):
+            for user_id in [u for u, expires_at in users.items() if expires_at <= now]:
+                self._remove(chat_id, user_id)
+
+        dirty, self._dirty = self._dirty, set()
+        for chat_id in dirty:
+            typing = set(self._typing.get(chat_id, ()))
+            stopped = self._announced.pop(chat_id, set()) - typing
+            if typing:
+                self._announced[chat_id] = typing
+            # A start and stop inside one interval cancel out
+            if typing or stopped:
+                await sio.emit('typing', {
+                    "chat_id": chat_id,
+                    "typing": sorted(typing),
+                    "stopped": sorted(stopped)
+                }, room=chat_id)
+                self.frames += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Typing flush failed: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"chats": len(self._typing), "events": self.events, "frames": self.frames}
+
+typing_tracker = TypingTracker(TYPING_FLUSH_SECONDS, TYPING_TIMEOUT_SECONDS)
+
 # ===== SOCKET.IO EVENTS =====
 
 @sio.event
@@ -698,69 +3237,88 @@ async def connect(sid, environ):
 @sio.event
 async def disconnect(sid):
     logging.info(f"Client disconnected: {sid}")
-    # Remove from active connections
-    for user_id, socket_id in list(active_connections.items()):
-        if socket_id == sid:
-            del active_connections[user_id]
-            await sio.emit('user_offline', {"user_id": user_id})
-            break
+    removed = connections.remove(sid)
+    # Offline only once the user's last device is gone, on any worker
+    if removed:
+        activity_buffer.touch(removed[0])
+    if removed and removed[1]:
+        typing_tracker.drop_user(removed[0])
+    if removed and await presence_disconnect(removed[0], sid):
+        presence_broadcaster.offline(removed[0])
 
 @sio.event
 async def authenticate(sid, data):
     user_id = data.get('user_id')
     if user_id:
-        active_connections[user_id] = sid
-        await update_last_seen(user_id)
+        connections.add(sid, user_id, data.get('device_id'))
+        first_connection = await presence_connect(user_id, sid, data.get('device_id'))
+        activity_buffer.touch(user_id, data.get('device_id'))
         
         # Get user's chats and join rooms
         chats = await db.chats.find({"participants": user_id}, {"_id": 0, "id": 1}).to_list(1000)
         for chat in chats:
-            sio.enter_room(sid, chat["id"])
+            await sio.enter_room(sid, chat["id"])
+        await sio.enter_room(sid, user_room(user_id))
         
         await sio.emit('authenticated', {"user_id": user_id}, room=sid)
-        await sio.emit('user_online', {"user_id": user_id})
+        if first_connection:
+            presence_broadcaster.online(user_id)
+
+@sio.event
+async def heartbeat(sid, data=None):
+    """Keep-alive from an idle client; refreshes last_seen and last_active"""
+    user_id = connections.user_of(sid)
+    if user_id:
+        activity_buffer.touch(user_id, connections.device_of(sid))
 
 @sio.event
 async def typing_start(sid, data):
+    """Start or refresh typing; clients resend while the user keeps typing"""
     chat_id = data.get('chat_id')
     user_id = data.get('user_id')
-    await sio.emit('typing', {"chat_id": chat_id, "user_id": user_id, "typing": True}, room=chat_id, skip_sid=sid)
+    if chat_id and user_id and await is_chat_member(chat_id, user_id):
+        typing_tracker.start(chat_id, user_id)
 
 @sio.event
 async def typing_stop(sid, data):
     chat_id = data.get('chat_id')
     user_id = data.get('user_id')
-    await sio.emit('typing', {"chat_id": chat_id, "user_id": user_id, "typing": False}, room=chat_id, skip_sid=sid)
+    if chat_id and user_id:
+        typing_tracker.stop(chat_id, user_id)
+
+@sio.on('send_message')
+async def socket_send_message(sid, data):
+    """Send over the open socket; same payload as POST /api/messages.
+
+    The sender is the user bound at authenticate, not a field of the
+    payload. The ack is {"message": ...} or {"error": {"status", "detail"}}.
+    """
+    user_id = connections.user_of(sid)
+    if not user_id:
+        return {"error": {"status": 401, "detail": "Not authenticated"}}
+    try:
+        message_data = MessageCreate.model_validate(data or {})
+    except ValidationError as e:
+        return {"error": {"status": 422, "detail": e.errors(include_url=False, include_context=False)}}
+    try:
+        message = await create_message(user_id, message_data, skip_sid=sid)
+    except HTTPException as e:
+        return {"error": {"status": e.status_code, "detail": e.detail}}
+    return {"message": message.model_dump()}
 
 @sio.event
 async def message_delivered(sid, data):
-    message_id = data.get('message_id')
+    """Ack delivery: {user_id, chat_id, seq} and/or {user_id, message_ids | message_id}"""
     user_id = data.get('user_id')
-    
-    # Update message status
-    await db.messages.update_one(
-        {"id": message_id},
-        {"$set": {"status": "delivered"}}
-    )
-    
-    message = await db.messages.find_one({"id": message_id}, {"_id": 0})
-    if message:
-        await sio.emit('message_status', {"message_id": message_id, "status": "delivered"}, room=message["chat_id"])
+    if user_id:
+        await acknowledge_messages(user_id, "delivered", data)
 
 @sio.event
 async def message_read(sid, data):
-    message_id = data.get('message_id')
+    """Ack reads, same payload as message_delivered"""
     user_id = data.get('user_id')
-    
-    # Update message status
-    await db.messages.update_one(
-        {"id": message_id},
-        {"$set": {"status": "read"}}
-    )
-    
-    message = await db.messages.find_one({"id": message_id}, {"_id": 0})
-    if message:
-        await sio.emit('message_status', {"message_id": message_id, "status": "read"}, room=message["chat_id"])
+    if user_id:
+        await acknowledge_messages(user_id, "read", data)
 
 @sio.event
 async def call_signal(sid, data):
@@ -768,9 +3326,9 @@ async def call_signal(sid, data):
     target_user_id = data.get('target_user_id')
     signal_data = data.get('signal')
     
-    if target_user_id in active_connections:
-        target_sid = active_connections[target_user_id]
-        await sio.emit('call_signal', signal_data, room=target_sid)
+    # Ring every live device of the target
+    if target_user_id:
+        await sio.emit('call_signal', signal_data, room=user_room(target_user_id))
 
 # Logging
 logging.basicConfig(
@@ -779,8 +3337,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes()
+    background_tasks.append(asyncio.create_task(presence_heartbeat()))
+    background_tasks.append(asyncio.create_task(presence_broadcaster.run()))
+    background_tasks.append(asyncio.create_task(typing_tracker.run()))
+    background_tasks.append(asyncio.create_task(activity_buffer.run()))
+    background_tasks.append(asyncio.create_task(upload_session_gc()))
+    background_tasks.append(asyncio.create_task(media_gc()))
+    await asyncio.to_thread(variant_cache.scan)
+    # INDEX_AUDIT=1 refuses to start when a handler query would collection-scan
+    if os.environ.get('INDEX_AUDIT', '').lower() in ('1', 'true', 'yes'):
+        report = await audit_query_plans()
+        logger.info(f"Query plan audit passed for {len(report)} query shapes")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    try:
+        await activity_buffer.flush()
+    except Exception as e:
+        logger.error(f"Final activity flush failed: {e}")
+    media_pipeline.shutdown()
+    await presence_shutdown()
     client.close()
 
 # Mount Socket.IO on the FastAPI app
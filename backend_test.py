@@ -175,8 +175,9 @@ class WABackendTester:
             response = requests.get(f"{self.api_url}/chats?user_id={self.user_token}")
             
             if response.status_code == 200:
-                chats = response.json()
-                if isinstance(chats, list):
+                page = response.json()
+                chats = page.get("chats") if isinstance(page, dict) else None
+                if isinstance(chats, list) and "next_cursor" in page and "total_unread" in page:
                     self.log_test("Chat - Get Chats", True, f"Found {len(chats)} chats")
                     return True
                 else:
@@ -225,8 +226,9 @@ class WABackendTester:
             response = requests.get(f"{self.api_url}/chats/{self.test_chat_id}/messages?user_id={self.user_token}")
             
             if response.status_code == 200:
-                messages = response.json()
-                if isinstance(messages, list):
+                page = response.json()
+                messages = page.get("messages") if isinstance(page, dict) else None
+                if isinstance(messages, list) and "prev_cursor" in page and "next_cursor" in page:
                     self.log_test("Message - Get Messages", True, f"Retrieved {len(messages)} messages")
                     return True
                 else:
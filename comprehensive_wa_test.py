@@ -201,7 +201,7 @@ class ComprehensiveWATest:
                     messages_response = requests.get(f"{self.api_url}/chats/{self.test_chat_id}/messages?user_id={self.users['Alice']['token']}")
                     
                     if messages_response.status_code == 200:
-                        messages = messages_response.json()
+                        messages = messages_response.json()["messages"]
                         if len(messages) >= 2:
                             self.log_test("Messaging - Bidirectional", True, f"Retrieved {len(messages)} messages", "", curl_alice)
                             return True
@@ -51,18 +51,18 @@ const ChatListScreen = () => {
         fetchChats();
       });
 
-      socket.on('user_online', (data) => {
-        console.log('User online:', data);
+      socket.on('new_messages', (data) => {
+        fetchChats();
       });
 
-      socket.on('user_offline', (data) => {
-        console.log('User offline:', data);
+      socket.on('presence', (data) => {
+        console.log('Presence:', data.updates);
       });
 
       return () => {
         socket.off('new_message');
-        socket.off('user_online');
-        socket.off('user_offline');
+        socket.off('new_messages');
+        socket.off('presence');
       };
     }
   }, [socket]);
@@ -70,7 +70,7 @@ const ChatListScreen = () => {
   const fetchChats = async () => {
     try {
       const response = await axios.get(`${API}/chats?user_id=${user.id}`);
-      const chatsData = response.data;
+      const chatsData = response.data.chats;
       
       const enrichedChats = await Promise.all(chatsData.map(async (chat) => {
         if (chat.type === 'direct') {
@@ -46,6 +46,8 @@ const ChatScreen = () => {
   const messagesEndRef = useRef(null);
   const fileInputRef = useRef(null);
   const typingTimeoutRef = useRef(null);
+  const typingSentAtRef = useRef(0);
+  const typingUsersRef = useRef(new Set());
 
   useEffect(() => {
     if (chatId && user) {
@@ -65,15 +67,19 @@ const ChatScreen = () => {
         }
       });
 
-      socket.on('typing_start', (data) => {
-        if (data.chat_id === chatId && data.user_id !== user.id) {
-          setOtherUserTyping(true);
+      socket.on('new_messages', (data) => {
+        if (data.chat_id === chatId) {
+          setMessages(prev => [...prev, ...data.messages]);
+          scrollToBottom();
         }
       });
 
-      socket.on('typing_stop', (data) => {
-        if (data.chat_id === chatId && data.user_id !== user.id) {
-          setOtherUserTyping(false);
+      socket.on('typing', (data) => {
+        if (data.chat_id === chatId) {
+          const typingUsers = typingUsersRef.current;
+          data.typing.forEach(id => id !== user.id && typingUsers.add(id));
+          data.stopped.forEach(id => typingUsers.delete(id));
+          setOtherUserTyping(typingUsers.size > 0);
         }
       });
 
@@ -87,8 +93,9 @@ const ChatScreen = () => {
 
       return () => {
         socket.off('new_message');
-        socket.off('typing_start');
-        socket.off('typing_stop');
+        socket.off('new_messages');
+        socket.off('typing');
+        typingUsersRef.current.clear();
         socket.off('message_edited');
         socket.off('message_deleted');
       };
@@ -134,8 +141,10 @@ const ChatScreen = () => {
   const handleTyping = (text) => {
     setMessageText(text);
     
-    if (!isTyping && text.length > 0) {
+    // The server expires typing after a few seconds, so refresh it while typing continues
+    if (text.length > 0 && (!isTyping || Date.now() - typingSentAtRef.current > 3000)) {
       setIsTyping(true);
+      typingSentAtRef.current = Date.now();
       socket?.emit('typing_start', { chat_id: chatId, user_id: user.id });
     }
 
@@ -28,7 +28,7 @@ const GroupsScreen = () => {
   const fetchGroups = async () => {
     try {
       const response = await axios.get(`${API}/chats?user_id=${user.id}`);
-      const groupChats = response.data.filter(chat => chat.type === 'group');
+      const groupChats = response.data.chats.filter(chat => chat.type === 'group');
       setGroups(groupChats);
     } catch (error) {
       console.error('Failed to fetch groups:', error);
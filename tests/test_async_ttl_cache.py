@@ -0,0 +1,162 @@
+import asyncio
+
+from server import AsyncTTLCache
+
+class Loader:
+    """Loader whose calls block until release() so tests control the interleaving"""
+    
+    def __init__(self):
+        self.calls = []
+        self.gate = asyncio.Event()
+    
+    def release(self):
+        self.gate.set()
+    
+    async def one(self, key):
+        self.calls.append(key)
+        call = len(self.calls)
+        await self.gate.wait()
+        return f"value-{key}-{call}"
+    
+    async def many(self, keys):
+        self.calls.append(tuple(keys))
+        call = len(self.calls)
+        await self.gate.wait()
+        return {key: f"value-{key}-{call}" for key in keys}
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_concurrent_misses_share_one_load():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader.one)
+        tasks = [asyncio.create_task(cache.get("k")) for _ in range(5)]
+        await asyncio.sleep(0)
+        loader.release()
+        values = await asyncio.gather(*tasks)
+        assert values == ["value-k-1"] * 5
+        assert loader.calls == ["k"]
+        assert await cache.get("k") == "value-k-1"
+    run(scenario())
+
+def test_cancelled_leader_does_not_strand_waiters():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader.one)
+        leader = asyncio.create_task(cache.get("k"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get("k"))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        loader.release()
+        assert await asyncio.wait_for(waiter, 1) == "value-k-2"
+        assert leader.cancelled()
+        assert not cache._inflight and not cache._stale
+    run(scenario())
+
+def test_cancelled_waiter_stays_cancelled():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader.one)
+        leader = asyncio.create_task(cache.get("k"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get("k"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        loader.release()
+        assert await leader == "value-k-1"
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert waiter.cancelled()
+    run(scenario())
+
+def test_invalidate_during_load_skips_caching():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader.one)
+        task = asyncio.create_task(cache.get("k"))
+        await asyncio.sleep(0)
+        cache.invalidate("k")
+        loader.release()
+        assert await task == "value-k-1"
+        assert await cache.get("k") == "value-k-2"
+        assert await cache.get("k") == "value-k-2"
+        assert loader.calls == ["k", "k"]
+    run(scenario())
+
+def test_loader_error_reaches_waiters_and_is_not_cached():
+    async def scenario():
+        calls = []
+        
+        async def failing(key):
+            calls.append(key)
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+        
+        cache = AsyncTTLCache(failing)
+        results = await asyncio.gather(cache.get("k"), cache.get("k"), return_exceptions=True)
+        assert [type(r) for r in results] == [ValueError, ValueError]
+        assert calls == ["k"]
+        assert not cache._inflight
+    run(scenario())
+
+def test_get_many_loads_misses_once_and_joins_inflight_loads():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader.one, loader.many)
+        cache.put("cached", "hit")
+        single = asyncio.create_task(cache.get("a"))
+        await asyncio.sleep(0)
+        many = asyncio.create_task(cache.get_many(["cached", "a", "b", "b", "c"]))
+        await asyncio.sleep(0)
+        loader.release()
+        assert await single == "value-a-1"
+        assert await many == {"cached": "hit", "a": "value-a-1", "b": "value-b-2", "c": "value-c-2"}
+        assert loader.calls == ["a", ("b", "c")]
+    run(scenario())
+
+def test_get_many_cancelled_leader_does_not_strand_waiters():
+    async def scenario():
+        loader = Loader()
+        cache = AsyncTTLCache(loader.one, loader.many)
+        leader = asyncio.create_task(cache.get_many(["a", "b"]))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get("a"))
+        await asyncio.sleep(0)
+        cache.invalidate("b")
+        leader.cancel()
+        await asyncio.sleep(0)
+        loader.release()
+        assert await asyncio.wait_for(waiter, 1) == "value-a-2"
+        assert not cache._inflight and not cache._stale
+    run(scenario())
+
+def test_size_bound_evicts_least_recently_used():
+    async def scenario():
+        loader = Loader()
+        loader.release()
+        cache = AsyncTTLCache(loader.one, max_size=2)
+        await cache.get("a")
+        await cache.get("b")
+        await cache.get("a")
+        await cache.get("c")
+        assert set(cache._entries) == {"a", "c"}
+        assert cache.evictions == 1
+    run(scenario())
+
+def test_peek_neither_loads_nor_counts():
+    async def scenario():
+        loader = Loader()
+        loader.release()
+        cache = AsyncTTLCache(loader.one, max_size=2)
+        assert cache.peek("a") is None
+        await cache.get("a")
+        await cache.get("b")
+        assert cache.peek("a") == "value-a-1"
+        await cache.get("c")
+        # peek did not refresh "a", so it was the one evicted
+        assert cache.peek("a") is None and cache.peek("b") == "value-b-2"
+        assert loader.calls == ["a", "b", "c"]
+        assert cache.hits == 0
+    run(scenario())
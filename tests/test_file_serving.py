@@ -0,0 +1,43 @@
+import pytest
+from fastapi import HTTPException
+
+from server import etag_matches, parse_range
+
+SIZE = 1000
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-10", (990, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=999-999", (999, 999)),
+    ("BYTES = 0-0", (0, 0)),
+])
+def test_parse_range_single_ranges(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+@pytest.mark.parametrize("header", [
+    "bytes=0-1,5-6",   # multipart/byteranges: serve the whole file
+    "items=0-10",
+    "bytes=abc",
+    "bytes=10-5",
+    "bytes=-0",
+    "bytes=-",
+])
+def test_parse_range_ignores_unsupported_or_invalid(header):
+    assert parse_range(header, SIZE) is None
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=2000-3000"])
+def test_parse_range_past_the_end_is_416(header):
+    with pytest.raises(HTTPException) as exc:
+        parse_range(header, SIZE)
+    assert exc.value.status_code == 416
+    assert exc.value.headers["Content-Range"] == f"bytes */{SIZE}"
+
+def test_etag_matches_uses_weak_comparison():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"abcd"', '"abc"')
@@ -0,0 +1,58 @@
+import operator
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from server import decode_keyset_cursor, encode_cursor, keyset_filter
+
+OPS = {"$lt": operator.lt, "$lte": operator.le, "$gt": operator.gt, "$gte": operator.ge}
+
+def matches(doc, query):
+    """Just enough of MongoDB's matcher for keyset_filter output"""
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+        elif isinstance(condition, dict):
+            if not all(OPS[op](doc[field], value) for op, value in condition.items()):
+                return False
+        elif doc[field] != condition:
+            return False
+    return True
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# Several messages share a timestamp, so ordering must fall back to id
+DOCS = [{"created_at": T0 + timedelta(seconds=i // 3), "id": f"m{i:02d}"} for i in range(12)]
+
+def test_keyset_filter_pages_through_ties_without_gaps_or_repeats():
+    for op, reverse in (("$lt", True), ("$gt", False)):
+        ordered = sorted(DOCS, key=lambda d: (d["created_at"], d["id"]), reverse=reverse)
+        seen = ordered[:4]
+        while len(seen) < len(ordered):
+            cursor = seen[-1]
+            query = keyset_filter("created_at", cursor["created_at"], cursor["id"], op)
+            page = [d for d in ordered if matches(d, query)][:4]
+            assert page == ordered[len(seen):len(seen) + 4]
+            seen += page
+        assert seen == ordered
+
+def test_keyset_filter_bounds_field_inclusively_for_the_index():
+    query = keyset_filter("created_at", T0, "m05", "$lt")
+    assert query["created_at"] == {"$lte": T0}
+    assert query["$or"] == [{"created_at": {"$lt": T0}}, {"created_at": T0, "id": {"$lt": "m05"}}]
+
+def test_decode_keyset_cursor_round_trips():
+    assert decode_keyset_cursor(encode_cursor(T0, "m05")) == (T0, "m05")
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor("x", "m05"),
+    encode_cursor(1, "m05"),
+    encode_cursor(T0.isoformat(), 5),
+    encode_cursor(T0.isoformat()),
+    "not base64!",
+])
+def test_decode_keyset_cursor_rejects_tampered_cursors(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_keyset_cursor(cursor)
+    assert error.value.status_code == 400
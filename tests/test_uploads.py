@@ -0,0 +1,25 @@
+from server import merge_ranges, stored_extension
+
+def test_merge_ranges_joins_overlapping_and_adjacent_chunks():
+    assert merge_ranges([[4, 8], [0, 4], [6, 10]]) == [[0, 10]]
+
+def test_merge_ranges_keeps_gaps():
+    assert merge_ranges([[10, 20], [0, 5], [5, 8]]) == [[0, 8], [10, 20]]
+
+def test_merge_ranges_handles_retried_and_contained_chunks():
+    assert merge_ranges([[0, 10], [2, 4], [0, 10]]) == [[0, 10]]
+    assert merge_ranges([]) == []
+
+def test_merge_ranges_does_not_mutate_the_session_ranges():
+    received = [[0, 4], [4, 8]]
+    merge_ranges(received)
+    assert received == [[0, 4], [4, 8]]
+
+def test_stored_extension_keeps_known_client_extensions():
+    assert stored_extension("photo.JPG", "image/jpeg") == ".jpg"
+    assert stored_extension("report.pdf", None) == ".pdf"
+
+def test_stored_extension_falls_back_to_the_content_type():
+    assert stored_extension("x.part", "image/png") == ".png"
+    assert stored_extension("notes", "text/plain; charset=utf-8") == ".txt"
+    assert stored_extension("../x.part", None) == ""